@@ -0,0 +1,105 @@
+import time
+import asyncio
+from collections import deque
+from logger import logger
+from config import config
+
+# Reactions showing a player their place in the queue
+POSITION_REACTS = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣', '🔟']
+LONG_QUEUE_REACT = '⏳'
+
+def position_react(position):
+    return POSITION_REACTS[position - 1] if position <= len(POSITION_REACTS) else LONG_QUEUE_REACT
+
+class QueuedAction:
+    def __init__(self, user_id, user_message, message):
+        self.user_id = user_id
+        self.user_message = user_message
+        self.message = message
+        self.queued_at = time.monotonic()
+        self.react = None
+
+    def waited(self):
+        return time.monotonic() - self.queued_at
+
+class ActionQueue:
+    """
+    Player actions waiting for their turn in one campaign, handled one at a time in
+    the order they arrived. Each player can only have one action waiting, and the
+    turn rules (game.max_previous_users) are checked against the turns still in
+    the queue, so the order is always one the rules allow.
+
+    Holds at most game.queue_size actions. Actions that have waited longer than
+    game.queue_max_wait seconds are dropped, and on_expired is called for them.
+
+    run_action is called with a list of actions. With game.batch_window set, the
+    queue waits that many seconds after an action arrives, and passes up to
+    game.max_batch_size actions that arrived in the meantime along with it.
+    """
+    def __init__(self, run_action, on_expired):
+        self.run_action = run_action
+        self.on_expired = on_expired
+        self.actions = deque()
+        self.current = []
+        self.worker_task = None
+
+    def user_ids(self):
+        return [action.user_id for action in self.actions]
+
+    # Players with turns still to come: the actions being handled, then the waiting ones
+    def turn_user_ids(self):
+        return [action.user_id for action in self.current] + self.user_ids()
+
+    # Actions being handled that no longer take a turn, because they were answered
+    # (and are in previous_users now) or dropped
+    def finish(self, actions):
+        self.current = [action for action in self.current if action not in actions]
+
+    # True if the user has an action waiting or being handled
+    def has_action(self, user_id):
+        return user_id in self.user_ids() or any(action.user_id == user_id for action in self.current)
+
+    # Returns the action's position in the queue, 0 if it will be handled straight
+    # away, or None if the queue is full
+    async def submit(self, action):
+        await self._evict_expired()
+        if len(self.actions) >= config['game']['queue_size']:
+            return None
+        self.actions.append(action)
+        if self.worker_task is None:
+            self.worker_task = asyncio.create_task(self._worker())
+        return len(self.actions) - (0 if self.current else 1)
+
+    async def _evict_expired(self):
+        expired = [action for action in self.actions if action.waited() > config['game']['queue_max_wait']]
+        for action in expired:
+            self.actions.remove(action)
+            await self.on_expired(action)
+
+    async def _collect_batch(self):
+        await asyncio.sleep(max(0, config['game']['batch_window'] - self.current[0].waited()))
+        while self.actions and len(self.current) < config['game']['max_batch_size']:
+            action = self.actions.popleft()
+            if action.waited() > config['game']['queue_max_wait']:
+                await self.on_expired(action)
+            else:
+                self.current.append(action)
+
+    async def _worker(self):
+        try:
+            while self.actions:
+                action = self.actions.popleft()
+                if action.waited() > config['game']['queue_max_wait']:
+                    await self.on_expired(action)
+                    continue
+                self.current = [action]
+                try:
+                    if config['game']['batch_window']:
+                        await self._collect_batch()
+                    await self.run_action(self.current)
+                except Exception as e:
+                    logger.error(f"Failed to handle queued action. Error: {e}")
+                finally:
+                    self.current = []
+        finally:
+            self.worker_task = None
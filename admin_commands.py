@@ -1,101 +1,220 @@
 import discord
 from logger import logger
 import game_logic as game
-from discord_client import get_public_channel, discord_safe_send, client_close
+import metrics
+import profiling
+import shards
+from discord_client import get_public_channel, discord_safe_send, client_close, StreamingMessage
 from config import config, VERSION
 
-async def picture(channel, params):
+# The campaign each admin is managing, by the ID of their DM channel with the bot.
+# Defaults to the first campaign.
+selected_campaigns = {}
+
+def get_selected_channel_id(dm_channel_id):
+    return selected_campaigns.get(dm_channel_id, config['discord']['channel_ids'][0])
+
+# None if the campaign is run by another worker process, see shards.py
+def get_selected_campaign(dm_channel_id):
+    return game.get_campaign(get_selected_channel_id(dm_channel_id))
+
+# The names of every campaign, including those run by other worker processes, by channel ID
+def _game_names():
+    if shards.shard_state is not None:
+        return shards.shard_state.game_names()
+    return {channel_id: campaign.game_context['game_name'] for channel_id, campaign in game.campaigns.items()}
+
+async def select_campaign(campaign, channel, params):
+    game_names = _game_names()
+    if params:
+        try:
+            channel_id = int(params)
+        except ValueError:
+            channel_id = None
+        if channel_id not in game_names:
+            await channel.send(f"{params}: No campaign in that channel.")
+            return
+        selected_campaigns[channel.id] = channel_id
+    selected = get_selected_channel_id(channel.id)
+    campaign_list = "\n".join(
+        f"{'**→**' if channel_id == selected else '-'} `{channel_id}` {game_name}"
+        for channel_id, game_name in game_names.items()
+    )
+    await channel.send(f"Admin commands apply to the selected campaign:\n{campaign_list}")
+
+async def picture(campaign, channel, params):
     if not config['experimental']['image_generation']:
         await channel.send("Image generation is disabled.")
         return
-    async with get_public_channel().typing():
-        image_url = await game.generate_image_from_scene()
-    if image_url == False:
+    async with get_public_channel(campaign).typing():
+        image_path = await game.generate_image_from_scene(campaign)
+    if image_path == False:
         await channel.send("Image generation failed.")
         return
-    logger.info(f"Generated image: {image_url}")
-    await get_public_channel().send(embed=discord.Embed().set_image(url=image_url))
+    logger.info(f"Generated image: {image_path}")
+    await get_public_channel(campaign).send(file=discord.File(image_path))
 
-async def instructions(channel, params):
+async def instructions(campaign, channel, params):
     with open(config['files']['instructions'], "r") as f:
         instructions = f.read()
-    await discord_safe_send(instructions, get_public_channel())
+    await discord_safe_send(instructions, get_public_channel(campaign))
 
-async def summarize(channel, params):
-    async with get_public_channel().typing():
-        chatgpt_response = await game.summarize_adventure()
+async def summarize(campaign, channel, params):
+    async with get_public_channel(campaign).typing():
+        chatgpt_response = await game.summarize_adventure(campaign)
     if chatgpt_response != False:
-        await discord_safe_send(chatgpt_response, get_public_channel())
+        await discord_safe_send(chatgpt_response, get_public_channel(campaign))
     else:
         await channel.send("Summarization failed.")
 
-async def new_game(channel, params):
-    await game.new_adventure(name=params)
-    await discord_safe_send("**A new adventure is beginning. Please create new characters!**", get_public_channel())
+async def new_game(campaign, channel, params):
+    await game.new_adventure(campaign, name=params)
+    await discord_safe_send("**A new adventure is beginning. Please create new characters!**", get_public_channel(campaign))
 
-async def rename(channel, params):
+async def rename(campaign, channel, params):
     if not params:
         await channel.send("Please provide a new name for the adventure.")
     else:
-        await game.rename_adventure(params)
+        await game.rename_adventure(campaign, params)
 
-async def test_dice(channel, params):
+async def restore(campaign, channel, params):
+    if not params:
+        backups = campaign.backups.list_backups()
+        if not backups:
+            await channel.send("There are no backups.")
+            return
+        lines = ["Restore one of these with `!restore (name)`. The current game is backed up first."]
+        for backup in backups:
+            details = f"{backup['game_name']}, {backup['entries']} log entries, {backup['stored_bytes']:,} bytes added" \
+                if backup['game_name'] is not None else f"{backup['stored_bytes']:,} bytes"
+            lines.append(f"- `{backup['name']}` {backup['created']}: {details}")
+        await discord_safe_send("\n".join(lines), channel)
+        return
+    try:
+        game_name = await game.restore_backup(campaign, params)
+    except KeyError:
+        await channel.send(f"{params}: No backup with that name. Use `!restore` to list them.")
+        return
+    await channel.send(f"Restored {params}: {game_name}.")
+    await discord_safe_send(f"**The adventure has been restored to an earlier point: {game_name}.**", get_public_channel(campaign))
+
+async def test_dice(campaign, channel, params):
     dice_test = " ".join(config['game']['dice_strings'])
     if config['game']['dice_reacts']:
         for dice_reacts in config['game']['dice_reacts']:
             dice_test += "\n" + " ".join(dice_reacts)
     await channel.send(dice_test)
 
-async def ping(channel, params):
+async def ping(campaign, channel, params):
     logger.info('Pong! (Received !ping command.)')
     await channel.send("Pong!")
 
-async def version(channel, params):
+async def version(campaign, channel, params):
     await channel.send(VERSION)
 
-async def shutdown(channel, params):
+async def shutdown(campaign, channel, params):
     logger.info("Received !shutdown command")
     await channel.send("Going offline...")
+    await game.flush_game_contexts()
     await client_close()
 
-async def prompt(channel, params):
+async def prompt(campaign, channel, params):
     if not params:
         await channel.send("Please provide prompt after the command.")
     else:
-        async with get_public_channel().typing():
-            admin_response = await game.respond_to_admin(params)
-        await discord_safe_send(admin_response, get_public_channel())
+        if config['discord']['stream_replies']:
+            streaming_message = StreamingMessage(get_public_channel(campaign))
+            async with get_public_channel(campaign).typing():
+                admin_response = await game.respond_to_admin(campaign, params, streaming_message.update)
+            await streaming_message.finish(admin_response)
+        else:
+            async with get_public_channel(campaign).typing():
+                admin_response = await game.respond_to_admin(campaign, params)
+            await discord_safe_send(admin_response, get_public_channel(campaign))
 
-async def nudge(channel, params):
+async def nudge(campaign, channel, params):
     if not params:
         await channel.send("Please provide prompt after the command.")
     else:
-        await game.admin_nudge(params)
+        await game.admin_nudge(campaign, params)
         await channel.send("Nudge added.")
 
-async def echo(channel, params):
-    await discord_safe_send(params, get_public_channel())
+async def echo(campaign, channel, params):
+    await discord_safe_send(params, get_public_channel(campaign))
 
-async def write(channel, params):
-    await game.write_story(params)
-    await discord_safe_send(params, get_public_channel())
+async def write(campaign, channel, params):
+    await game.write_story(campaign, params)
+    await discord_safe_send(params, get_public_channel(campaign))
 
-async def clear_previous_users(channel, params):
-    await game.clear_previous_users()
+async def clear_previous_users(campaign, channel, params):
+    await game.clear_previous_users(campaign)
     await channel.send("Previous users cleared.")
 
-async def stats(channel, params):
+async def stats(campaign, channel, params):
+    persistence_stats = campaign.store.persistence_stats
     stats = f"""
-**Game Name:** {game.game_context['game_name']}
-**Last Token Usage:** {game.game_context['token_usage']}
-**Last Status Update:** {game.game_context['last_status_update']}
-**Log entries:** {len(game.game_context['log'])}
-**Characters:** {len(game.game_context['characters'])}
-**Users awaiting turn:** {len(game.game_context['previous_users'])}
+**Game Name:** {campaign.game_context['game_name']}
+**Channel:** {campaign.channel_id}
+**Last Token Usage:** {campaign.game_context['token_usage']} (estimated {campaign.last_estimated_usage})
+**Log Tokens (estimated):** {campaign.log_tokens} of {config['game']['max_log_tokens']}
+**Last Status Update:** {campaign.game_context['last_status_update']}
+**Log entries:** {len(campaign.game_context['log'])}
+**Characters:** {len(campaign.game_context['characters'])}
+**Users awaiting turn:** {len(campaign.game_context['previous_users'])}
+**Saves:** {persistence_stats['save_requests']} requested, {persistence_stats['writes']} written ({persistence_stats['save_requests'] - persistence_stats['writes']} coalesced)
     """
-    await channel.send(stats)
+    metric_lines = metrics.stats_lines()
+    if metric_lines:
+        stats += "**Timings and usage (all campaigns):**\n" + "\n".join(metric_lines)
+    await discord_safe_send(stats, channel)
 
-async def kick(channel, params):
+async def profile(campaign, channel, params):
+    if params.strip().lower() == "stop":
+        if not profiling.stop():
+            await channel.send("No profile is running.")
+        return
+    if profiling.is_running():
+        await channel.send("A profile is already running. Use `!profile stop` to end it.")
+        return
+    try:
+        seconds = float(params) if params else 30
+        if seconds <= 0:
+            raise ValueError
+    except ValueError:
+        await channel.send("Please give the number of seconds to profile for, or `stop`.")
+        return
+    seconds = min(seconds, profiling.MAX_SECONDS)
+    await channel.send(f"Profiling for {seconds:g} seconds. Use `!profile stop` to finish early.")
+    summary = await profiling.profile(seconds)
+    await discord_safe_send(summary, channel)
+
+async def search(campaign, channel, params):
+    search_index = campaign.adventure_log.search_index
+    if search_index is None:
+        await channel.send("Adventure logs are disabled, there's nothing to search.")
+        return
+    # Search every campaign with "!search all ..."
+    channel_id = campaign.channel_id
+    if params.lower().startswith("all "):
+        channel_id = None
+        params = params[4:]
+    if not params.strip():
+        await channel.send('Please give some words to search for, e.g. `!search dragon "old mill"`.')
+        return
+    # Make sure everything written so far can be found
+    campaign.adventure_log.flush()
+    results = search_index.search(params, channel_id)
+    if not results:
+        await channel.send(f"No adventure log entries found for: {params}")
+        return
+    lines = []
+    for result in results:
+        campaign_name = f"`{result['channel_id']}` " if channel_id is None else ""
+        speaker = f"{result['speaker']}: " if result['speaker'] else ""
+        lines.append(f"- {campaign_name}**{result['game_name']}** ({result['written_at']}) {speaker}{result['snippet']}")
+    await discord_safe_send("\n".join(lines), channel)
+
+async def kick(campaign, channel, params):
     if not params:
         await channel.send("Please provide a character to kick.")
         return
@@ -103,11 +222,21 @@ async def kick(channel, params):
     params = params.split(",", 1)
     user_id_or_name = params[0].rstrip()
     custom_message = params[1].lstrip() if len(params) > 1 else None
-    response = await game.character_leaves(user_id_or_name, custom_message)
-    await get_public_channel().send(response)
+    response = await game.character_leaves(campaign, user_id_or_name, custom_message)
+    await get_public_channel(campaign).send(response)
+
+# The (command, handler, reject_if_game_locked) a message starts with, with command
+# being the one that matched when there are several, or None
+def find_command(user_message):
+    for commands, handler, reject_if_game_locked in command_handlers:
+        for command in (commands,) if isinstance(commands, str) else commands:
+            if user_message.lower().startswith(command):
+                return command, handler, reject_if_game_locked
+    return None
 
 # (command, handler, reject_if_game_locked)
 command_handlers = [
+    ("!campaign",                 select_campaign,      False),
     ("!clearprev",                clear_previous_users, False),
     ("!echo",                     echo,                 False),
     ("!instructions",             instructions,         False),
@@ -116,13 +245,20 @@ command_handlers = [
     ("!nudge",                    nudge,                False),
     ("!picture",                  picture,              False),
     ("!ping",                     ping,                 False),
+    ("!profile",                  profile,              False),
     ("!prompt",                   prompt,               True ),
     ("!rename",                   rename,               False),
+    ("!restore",                  restore,              False),
+    ("!search",                   search,               False),
     ("!shutdown",                 shutdown,             False),
     ("!stats",                    stats,                False),
-    # User actions can automatically trigger a summarization, so reject just in case
-    (("!summarise","!summarize"), summarize,            True ),
+    # Summaries run alongside play, and only one runs at a time
+    (("!summarise","!summarize"), summarize,            False),
     ("!testdice",                 test_dice,            False),
     ("!version",                  version,              False),
     ("!write",                    write,                True ),
 ]
+
+# Commands that don't use the selected campaign. With several worker processes, these
+# run in the one that received them, and the rest in the one running the campaign.
+local_commands = {select_campaign, ping, profile, shutdown, version}
@@ -1,49 +1,129 @@
 import os
-from config import config
-
-# Ensure the directory adventure_logs/ is created when imported
-log_dir = config['files']['adventure_logs']
-logging_enabled = bool(log_dir)
-
-if logging_enabled and not os.path.exists(log_dir):
-    os.makedirs(log_dir)
-
-current_log_path = None
-
-def set_log_name(log_name):
-    global current_log_path
-    if logging_enabled:
-        # Make filename safe
-        log_file_name = "".join(c for c in log_name if c.isalnum() or c in (' ','-','_')).rstrip()
-        current_log_path = os.path.join(log_dir, f"{log_file_name}.md")
-
-def _append_to_log(content):
-    if current_log_path is None:
-        raise ValueError("Log name is not set. Call set_log_name() first.")
-    with open(current_log_path, "a", encoding="utf-8") as log_file:
-        log_file.write(content + "\n\n")
-
-def rename_log(new_log_name):
-    global current_log_path
-    if logging_enabled:
-        if current_log_path is None:
+import sqlite3
+import asyncio
+from datetime import datetime
+from logger import logger
+import metrics
+
+class AdventureLog:
+    """
+    A markdown record of one campaign's story, in log_dir. Disabled if log_dir is false.
+
+    Writes are buffered, and a background task writes them together flush_delay
+    seconds after the first one, keeping the file open between writes. Without the
+    background task running, writes are made straight away.
+
+    Written entries are added to search_index, if there is one, with the time each
+    was added.
+    """
+    def __init__(self, log_dir, flush_delay, channel_id=None, search_index=None):
+        self.log_dir = log_dir
+        self.flush_delay = flush_delay
+        self.channel_id = channel_id
+        self.search_index = search_index
+        self.logging_enabled = bool(log_dir)
+        self.current_log_path = None
+        self.log_file = None
+        self.pending = []   # (time added, text)
+        self.writer_task = None
+        self.writer_dirty = None
+
+        # Ensure the log directory is created
+        if self.logging_enabled and not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+
+    # Index anything written while the bot wasn't running
+    def catch_up_index(self):
+        if self.logging_enabled and self.search_index:
+            for file_name in os.listdir(self.log_dir):
+                if file_name.endswith(".md"):
+                    self._update_index(os.path.join(self.log_dir, file_name))
+
+    def set_log_name(self, log_name):
+        if self.logging_enabled:
+            # Anything pending belongs to the previous log
+            self.flush()
+            self._close()
+            # Make filename safe
+            log_file_name = "".join(c for c in log_name if c.isalnum() or c in (' ','-','_')).rstrip()
+            self.current_log_path = os.path.join(self.log_dir, f"{log_file_name}.md")
+
+    def _append_to_log(self, content):
+        if self.current_log_path is None:
             raise ValueError("Log name is not set. Call set_log_name() first.")
-        new_log_path = os.path.join(log_dir, f"{new_log_name}.md")
-        os.rename(current_log_path, new_log_path)
-        current_log_path = new_log_path
-
-def add_storyteller(quote):
-    if logging_enabled:
-        # Add "> " before each line in quote
-        quote = "\n".join([f"> {line}" for line in quote.split("\n")])
-        _append_to_log(quote)
-
-def add_quote(speaker, quote):
-    if logging_enabled:
-        content = f"#### {speaker}\n{quote}"
-        _append_to_log(content)
-
-def add_action(action_text):
-    if logging_enabled:
-        content = f"_{action_text}_"
-        _append_to_log(content)
+        self.pending.append((datetime.now(), content + "\n\n"))
+        if self.writer_task is None:
+            self.flush()
+        else:
+            self.writer_dirty.set()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with metrics.timed("adventure_log_write"):
+            if self.log_file is None:
+                self.log_file = open(self.current_log_path, "a", encoding="utf-8")
+            self.log_file.write("".join(text for _, text in self.pending))
+            self.log_file.flush()
+        written = list(self.pending)
+        self.pending.clear()
+        self._update_index(self.current_log_path, written)
+
+    def _update_index(self, log_path, written=()):
+        if self.search_index:
+            try:
+                self.search_index.update(log_path, self.channel_id, written)
+            except sqlite3.Error as e:
+                logger.error(f"Failed to index adventure log {log_path}. Error: {e}")
+
+    def _close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def rename_log(self, new_log_name):
+        if self.logging_enabled:
+            if self.current_log_path is None:
+                raise ValueError("Log name is not set. Call set_log_name() first.")
+            # Pending writes go to the file before it's renamed
+            self.flush()
+            self._close()
+            new_log_path = os.path.join(self.log_dir, f"{new_log_name}.md")
+            os.rename(self.current_log_path, new_log_path)
+            if self.search_index:
+                self.search_index.rename(self.current_log_path, new_log_path)
+            self.current_log_path = new_log_path
+
+    async def writer(self):
+        while True:
+            await self.writer_dirty.wait()
+            await asyncio.sleep(self.flush_delay)
+            self.writer_dirty.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error(f"Failed to write adventure log. Error: {e}")
+
+    def start_writer(self):
+        if self.writer_task is not None or not self.logging_enabled:
+            return
+        self.writer_dirty = asyncio.Event()
+        self.writer_task = asyncio.create_task(self.writer())
+        if self.pending:
+            self.writer_dirty.set()
+
+    def add_storyteller(self, quote):
+        if self.logging_enabled:
+            # Add "> " before each line in quote
+            quote = "\n".join([f"> {line}" for line in quote.split("\n")])
+            self._append_to_log(quote)
+
+    def add_quote(self, speaker, quote):
+        if self.logging_enabled:
+            content = f"#### {speaker}\n{quote}"
+            self._append_to_log(content)
+
+    def add_action(self, action_text):
+        if self.logging_enabled:
+            content = f"_{action_text}_"
+            self._append_to_log(content)
@@ -0,0 +1,198 @@
+import os
+import json
+import zlib
+import asyncio
+import hashlib
+import threading
+import yaml
+from datetime import datetime
+from logger import logger
+from context import _copy_context, _json_default, _json_object_hook
+
+# Log entries are split into chunks where an entry's hash is a multiple of this, so
+# chunks average this many entries. The boundaries depend only on the entries around
+# them, so when the start of the log is summarized away the rest still matches.
+CHUNK_ENTRIES = 16
+
+class BackupStore:
+    """
+    Backups of one campaign's game context, in files.backup_dir.
+
+    Each backup is a manifest in manifests/, listing the objects it is made of:
+    one for everything but the log, and one for each chunk of the log. Objects are
+    compressed and stored in objects/ by the hash of their contents, so a chunk
+    shared by several backups is only stored once, and each backup only adds the
+    part of the log that changed.
+
+    Old backups are removed according to files.backup_keep_last, backup_keep_daily
+    and backup_keep_weekly, along with any objects no backup uses any more.
+    YAML backups made by older versions are left alone, and can still be restored.
+    """
+    def __init__(self, files):
+        self.files = files
+        self.backup_dir = files['backup_dir']
+        self.objects_dir = os.path.join(self.backup_dir, "objects")
+        self.manifests_dir = os.path.join(self.backup_dir, "manifests")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        # Backups run in threads, and removing objects mustn't race with writing them
+        self.lock = threading.Lock()
+
+    async def backup_game_context(self, game_context):
+        name = await asyncio.to_thread(self._backup, _copy_context(game_context))
+        logger.info(f"Backup created: {name}")
+        return name
+
+    # Returns the game context saved in a backup. Raises KeyError if there's no such backup.
+    async def load_backup(self, name):
+        return await asyncio.to_thread(self._load, name)
+
+    # Newest first, as dicts with name, created, game_name, entries and stored_bytes,
+    # the size of the objects the backup added
+    def list_backups(self):
+        backups = []
+        for name in self._manifest_names():
+            manifest = self._read_manifest(name)
+            backups.append({"name": name, **{key: manifest[key] for key in ("created", "game_name", "entries", "stored_bytes")}})
+        for filename in os.listdir(self.backup_dir):
+            if filename.endswith(".yaml"):
+                path = os.path.join(self.backup_dir, filename)
+                backups.append({
+                    "name": filename, "created": datetime.fromtimestamp(os.path.getmtime(path)).isoformat(timespec="seconds"),
+                    "game_name": None, "entries": None, "stored_bytes": os.path.getsize(path),
+                })
+        return sorted(backups, key=lambda backup: backup["created"], reverse=True)
+
+    def _backup(self, game_context):
+        with self.lock:
+            created = datetime.now()
+            name = created.strftime("%Y%m%d_%H%M%S")
+            # Backups made in the same second get a number
+            same_second = [_sort_key(other)[1] for other in self._manifest_names() if other.startswith(name)]
+            if same_second:
+                name += f"_{max(same_second) + 1}"
+
+            stored_bytes = 0
+            rest = {key: value for key, value in game_context.items() if key != "log"}
+            context_hash, written = self._put_object(rest)
+            stored_bytes += written
+            chunk_hashes = []
+            for chunk in _chunk_log(game_context["log"]):
+                chunk_hash, written = self._put_object(chunk)
+                chunk_hashes.append(chunk_hash)
+                stored_bytes += written
+
+            manifest = {
+                "created": created.isoformat(timespec="seconds"),
+                "game_name": game_context["game_name"],
+                "entries": len(game_context["log"]),
+                "stored_bytes": stored_bytes,
+                "context": context_hash,
+                "log": chunk_hashes,
+            }
+            # The manifest goes last, so a backup interrupted by a crash is just ignored
+            _write_atomic(self._manifest_path(name), json.dumps(manifest, indent=1).encode("utf-8"))
+            self._apply_retention()
+        return name
+
+    def _load(self, name):
+        with self.lock:
+            if name.endswith(".yaml"):
+                path = os.path.join(self.backup_dir, os.path.basename(name))
+                if not os.path.exists(path):
+                    raise KeyError(name)
+                with open(path, 'r', encoding="utf-8") as f:
+                    game_context = yaml.load(f, Loader=yaml.SafeLoader)
+                game_context.pop("journal_seq", None)
+                return game_context
+
+            if not os.path.exists(self._manifest_path(name)):
+                raise KeyError(name)
+            manifest = self._read_manifest(name)
+            game_context = self._get_object(manifest["context"])
+            game_context["log"] = [entry for chunk_hash in manifest["log"] for entry in self._get_object(chunk_hash)]
+            # JSON object keys are always strings
+            game_context["characters"] = {int(user_id): character for user_id, character in game_context["characters"].items()}
+            return game_context
+
+    # Returns the hash, and how many bytes were written, 0 if it was already stored
+    def _put_object(self, value):
+        data = json.dumps(value, default=_json_default, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        object_hash = hashlib.sha256(data).hexdigest()
+        path = self._object_path(object_hash)
+        if os.path.exists(path):
+            return object_hash, 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed = zlib.compress(data)
+        _write_atomic(path, compressed)
+        return object_hash, len(compressed)
+
+    def _get_object(self, object_hash):
+        with open(self._object_path(object_hash), 'rb') as f:
+            data = zlib.decompress(f.read())
+        return json.loads(data.decode("utf-8"), object_hook=_json_object_hook)
+
+    def _apply_retention(self):
+        names = self._manifest_names()
+        keep = set(names[:max(1, self.files['backup_keep_last'])])
+        # The newest backup of each of the last few days and weeks
+        for period_format, count in (("%Y-%m-%d", self.files['backup_keep_daily']), ("%G-W%V", self.files['backup_keep_weekly'])):
+            periods = set()
+            for name in names:
+                period = datetime.strptime(name[:15], "%Y%m%d_%H%M%S").strftime(period_format)
+                if period not in periods and len(periods) < count:
+                    periods.add(period)
+                    keep.add(name)
+        removed = [name for name in names if name not in keep]
+        if not removed:
+            return
+        for name in removed:
+            os.remove(self._manifest_path(name))
+
+        # Remove objects that no remaining backup uses
+        used = set()
+        for name in keep:
+            manifest = self._read_manifest(name)
+            used.add(manifest["context"])
+            used.update(manifest["log"])
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            for object_hash in os.listdir(prefix_dir):
+                if object_hash not in used:
+                    os.remove(os.path.join(prefix_dir, object_hash))
+        logger.info(f"Removed {len(removed)} old backups from {self.backup_dir}")
+
+    # Newest first
+    def _manifest_names(self):
+        return sorted((filename[:-5] for filename in os.listdir(self.manifests_dir) if filename.endswith(".json")), key=_sort_key, reverse=True)
+
+    def _read_manifest(self, name):
+        with open(self._manifest_path(name), 'r', encoding="utf-8") as f:
+            return json.load(f)
+
+    def _manifest_path(self, name):
+        return os.path.join(self.manifests_dir, os.path.basename(name) + ".json")
+
+    def _object_path(self, object_hash):
+        return os.path.join(self.objects_dir, object_hash[:2], object_hash)
+
+# Backup names are the time they were made, with _2, _3... for more in the same second
+def _sort_key(name):
+    number = name[16:]
+    return name[:15], int(number) if number else 1
+
+def _chunk_log(log):
+    chunk = []
+    for entry in log:
+        chunk.append(entry)
+        if zlib.crc32(entry["content"].encode("utf-8")) % CHUNK_ENTRIES == 0:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _write_atomic(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
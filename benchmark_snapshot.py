@@ -0,0 +1,67 @@
+# Compares loading and saving a game context as YAML and as a binary snapshot.
+# Usage: python benchmark_snapshot.py config.yaml [--tokens 75000] [--repeat 5]
+# The game context is made up, with a log of about --tokens tokens, which defaults
+# to game.max_log_tokens. Nothing is written outside a temporary directory.
+import os
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime
+
+parser = argparse.ArgumentParser(description="Benchmark game context snapshot formats")
+parser.add_argument("config")
+parser.add_argument("--tokens", type=int, help="Log size in tokens, defaults to game.max_log_tokens")
+parser.add_argument("--repeat", type=int, default=5, help="Runs of each, the fastest is reported")
+args = parser.parse_args()
+
+# config.py reads the config file named in sys.argv[1]
+from config import config
+from context import GameStore, _read_snapshot
+
+WORDS = "the party presses on through the mist as distant bells ring and something stirs in the dark".split()
+
+def make_context(tokens, rng):
+    log = [{"role": "system", "content": config['prompts']['base'], "tokens": 300}]
+    total = 0
+    while total < tokens:
+        role = rng.choice(["user", "assistant", "assistant"])
+        words = rng.randint(10, 40) if role == "user" else rng.randint(80, 300)
+        content = " ".join(rng.choice(WORDS) for _ in range(words)) + " ⚔️"
+        log.append({"role": role, "content": content, "tokens": words * 4 // 3})
+        total += words * 4 // 3
+    characters = {
+        100 + i: {"name": f"Player {i}", "race": "elf", "pronouns": "they", "class": "ranger", "appearance": "tall, in a green cloak"}
+        for i in range(6)
+    }
+    return {
+        "game_name": "Benchmark", "characters": characters, "log": log, "previous_users": [100],
+        "memory": {"arc": " ".join(WORDS * 20), "chapters": [{"content": " ".join(WORDS * 40), "tokens": 800}] * 5},
+        "token_usage": 1234, "status": "Benchmarking", "last_status_update": datetime.now(),
+    }
+
+def best_of(func):
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def benchmark(snapshot_format, directory, context):
+    files = {**config['files'], 'game': os.path.join(directory, "game_context.yaml"), 'snapshot_format': snapshot_format,
+             'backup_dir': os.path.join(directory, "backups"), 'fsync': "never"}
+    store = GameStore(files)
+    save = best_of(lambda: store._write_files((context, 0), []))
+    load = best_of(lambda: _read_snapshot(store.snapshot_path))
+    loaded, _ = _read_snapshot(store.snapshot_path)
+    assert loaded["log"] == context["log"] and loaded["characters"] == context["characters"]
+    return save, load, os.path.getsize(store.snapshot_path)
+
+context = make_context(args.tokens or config['game']['max_log_tokens'], random.Random(1))
+print(f"{len(context['log'])} log entries, {sum(len(entry['content']) for entry in context['log']):,} characters")
+print(f"{'format':<8} {'save':>9} {'load':>9} {'size':>11}")
+with tempfile.TemporaryDirectory() as directory:
+    for snapshot_format in ("yaml", "binary"):
+        save, load, size = benchmark(snapshot_format, directory, context)
+        print(f"{snapshot_format:<8} {save * 1000:>7.1f}ms {load * 1000:>7.1f}ms {size:>10,}B")
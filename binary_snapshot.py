@@ -0,0 +1,126 @@
+import sys
+import json
+import zlib
+import struct
+from array import array
+from itertools import accumulate
+
+# Binary game context snapshots, for files.snapshot_format: binary.
+#
+# Layout, little endian:
+#   MAGIC, version (u16)
+#   header length (u32), header: JSON with everything but the log
+#   entry count (u32)
+#   roles: one byte per entry, an index into ROLES
+#   tokens: i32 per entry, -1 if the entry has no count
+#   content lengths: u32 per entry, in characters
+#   text length (u32), text: every entry's content, UTF-8
+#   CRC32 of everything before it (u32)
+#
+# The log is stored a column at a time, so loading decodes all the text at once
+# instead of parsing every entry. Characters are stored as rows in the header,
+# with the field names alongside so fields can be added later.
+
+MAGIC = b"STSNAP"
+VERSION = 1
+ROLES = ("system", "user", "assistant")
+CHARACTER_FIELDS = ("name", "race", "pronouns", "class", "appearance")
+
+def is_snapshot(data):
+    return data[:len(MAGIC)] == MAGIC
+
+def dumps(context, journal_seq, json_default=None):
+    log = context["log"]
+    entry_extras = {}
+    roles = bytearray()
+    for position, entry in enumerate(log):
+        roles.append(ROLES.index(entry["role"]))
+        extra = {key: value for key, value in entry.items() if key not in ("role", "content", "tokens")}
+        if extra:
+            entry_extras[position] = extra
+    tokens = array("i", (entry.get("tokens", -1) for entry in log))
+    lengths = array("I", (len(entry["content"]) for entry in log))
+    text = "".join(entry["content"] for entry in log).encode("utf-8")
+
+    characters = []
+    for user_id, character in context["characters"].items():
+        extra = {key: value for key, value in character.items() if key not in CHARACTER_FIELDS}
+        characters.append([user_id] + [character.get(field) for field in CHARACTER_FIELDS] + [extra or None])
+    header = {
+        "context": {key: value for key, value in context.items() if key not in ("log", "characters")},
+        "journal_seq": journal_seq,
+        "character_fields": CHARACTER_FIELDS,
+        "characters": characters,
+        "entry_extras": entry_extras,
+    }
+    header = json.dumps(header, default=json_default, ensure_ascii=False).encode("utf-8")
+
+    parts = [
+        MAGIC, struct.pack("<HI", VERSION, len(header)), header,
+        struct.pack("<I", len(log)), bytes(roles),
+        _little_endian(tokens), _little_endian(lengths),
+        struct.pack("<I", len(text)), text,
+    ]
+    body = b"".join(parts)
+    return body + struct.pack("<I", zlib.crc32(body))
+
+# Returns the game context and the journal sequence number it includes
+def loads(data, json_object_hook=None):
+    if not is_snapshot(data):
+        raise ValueError("Not a game snapshot")
+    body, (crc,) = data[:-4], struct.unpack("<I", data[-4:])
+    if zlib.crc32(body) != crc:
+        raise ValueError("Game snapshot is corrupt")
+    offset = len(MAGIC)
+    version, header_length = struct.unpack_from("<HI", body, offset)
+    if version > VERSION:
+        raise ValueError(f"Game snapshot version {version} is newer than this bot supports ({VERSION})")
+    offset += 6
+    header = json.loads(body[offset:offset + header_length].decode("utf-8"), object_hook=json_object_hook)
+    offset += header_length
+
+    (count,) = struct.unpack_from("<I", body, offset)
+    offset += 4
+    roles = body[offset:offset + count]
+    offset += count
+    tokens = _read_array("i", body, offset, count)
+    offset += 4 * count
+    lengths = _read_array("I", body, offset, count)
+    offset += 4 * count
+    (text_length,) = struct.unpack_from("<I", body, offset)
+    offset += 4
+    text = body[offset:offset + text_length].decode("utf-8")
+
+    ends = list(accumulate(lengths))
+    starts = [0] + ends[:-1]
+    log = []
+    for role, start, end, entry_tokens in zip(roles, starts, ends, tokens):
+        entry = {"role": ROLES[role], "content": text[start:end]}
+        if entry_tokens >= 0:
+            entry["tokens"] = entry_tokens
+        log.append(entry)
+    for position, extra in header["entry_extras"].items():
+        log[int(position)].update(extra)
+
+    fields = header["character_fields"]
+    characters = {}
+    for row in header["characters"]:
+        character = dict(zip(fields, row[1:1 + len(fields)]))
+        if row[-1]:
+            character.update(row[-1])
+        characters[row[0]] = character
+
+    return {**header["context"], "characters": characters, "log": log}, header["journal_seq"]
+
+def _little_endian(values):
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def _read_array(typecode, data, offset, count):
+    values = array(typecode)
+    values.frombytes(data[offset:offset + values.itemsize * count])
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
@@ -0,0 +1,85 @@
+import os
+import asyncio
+from logger import logger
+from config import config
+from context import GameStore, snapshot_path
+from sqlite_store import SqliteStore
+from backups import BackupStore
+from adventure_log import AdventureLog
+from search_index import open_search_index
+from world_index import open_world_index
+
+class Campaign:
+    """Everything belonging to one game, played in one Discord channel."""
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.files = campaign_files(channel_id)
+        if len(config['discord']['channel_ids']) > 1 and self.files['game'] == config['files']['game']:
+            logger.info(f"Channel {channel_id} keeps the game, backups and adventure logs from before there were several campaigns")
+        self.lock = asyncio.Lock()
+        if self.files['storage'] == "sqlite":
+            self.store = SqliteStore(self.files, channel_id)
+        else:
+            self.store = GameStore(self.files)
+        self.backups = BackupStore(self.files)
+        # All campaigns share one search index, in the top adventure log directory
+        search_index = open_search_index(config['files']['adventure_logs']) if config['files']['adventure_logs'] else None
+        self.adventure_log = AdventureLog(self.files['adventure_logs'], self.files['save_delay'], channel_id, search_index)
+        # Facts about the world, for prompts with only the recent turns
+        self.world_index = open_world_index(config['files']['world_index']) if config['game']['recent_tokens'] else None
+        self.game_context = None
+        # Changes made since the game context was last saved, written out by game_logic._save()
+        self.pending_changes = []
+        # Estimated tokens in the log, kept up to date as entries are added and removed
+        self.log_tokens = 0
+        # Positions in the log of system entries after the base prompt, removed after the next reply
+        self.system_entries = []
+        # Position in the log of the last assistant entry, or None
+        self.last_assistant = None
+        # Estimated total tokens for the last response, to compare with token_usage
+        self.last_estimated_usage = -1
+        # The arc and recent chapters, sent with every request
+        self.memory_entry = None
+        # Only one summary runs at a time
+        self.summary_task = None
+        # Player actions waiting for their turn, see action_queue.py
+        self.action_queue = None
+
+# With one channel, files are used as configured. With several, each campaign
+# gets its own game file, backup directory and adventure log directory, except
+# that the first channel keeps the files of a game from before there were several.
+def campaign_files(channel_id):
+    if len(config['discord']['channel_ids']) > 1 and not _has_single_campaign_files(channel_id):
+        return _suffixed_files(channel_id)
+    return dict(config['files'])
+
+def _suffixed_files(channel_id):
+    files = dict(config['files'])
+    name, extension = os.path.splitext(files['game'])
+    files['game'] = f"{name}_{channel_id}{extension}"
+    files['backup_dir'] = os.path.join(files['backup_dir'], str(channel_id))
+    if files['adventure_logs']:
+        files['adventure_logs'] = os.path.join(files['adventure_logs'], str(channel_id))
+    return files
+
+# The game file, binary snapshot and journal, in either snapshot format
+def _game_paths(files):
+    return [files['game'], snapshot_path({**files, 'snapshot_format': "binary"}), files['game'] + ".journal"]
+
+# True for the first channel when there are files from when the bot ran one campaign,
+# and none of the channel's own. Otherwise adding a channel would start its game over.
+def _has_single_campaign_files(channel_id):
+    if channel_id != config['discord']['channel_ids'][0]:
+        return False
+    files, own_files = config['files'], _suffixed_files(channel_id)
+    own_paths = _game_paths(own_files) + [own_files['backup_dir']]
+    if files['adventure_logs']:
+        own_paths.append(own_files['adventure_logs'])
+    if any(os.path.exists(path) for path in own_paths):
+        return False
+
+    manifests_dir = os.path.join(files['backup_dir'], "manifests")
+    log_dir = files['adventure_logs']
+    return any(os.path.exists(path) for path in _game_paths(files)) \
+        or (os.path.isdir(manifests_dir) and len(os.listdir(manifests_dir)) > 0) \
+        or (bool(log_dir) and os.path.isdir(log_dir) and any(name.endswith(".md") for name in os.listdir(log_dir)))
@@ -1,3 +1,4 @@
+import re
 import yaml
 import sys
 from logger import logger
@@ -10,6 +11,84 @@ config_filename = sys.argv[1] if len(sys.argv) > 1 else "config.yaml"
 with open(config_filename, "r", encoding="utf-8") as file:
     config = yaml.safe_load(file)
 
+# Defaults for settings added after the config file format was first released,
+# so older config files keep working
+defaults = {
+    'discord': {
+        'stream_replies': False,
+        'stream_edit_interval': 1.5,
+        'shard_count': False,
+        'shard_ids': False,
+    },
+    'openai': {
+        'max_concurrent_requests': 4,
+        'request_timeout': 60,
+        'base_url': None,
+        'main_fallback_models': [],
+        'summary_fallback_models': [],
+        'hedge_after': False,
+        'breaker_failures': 5,
+        'breaker_cooldown': 60,
+        'endpoints': {},
+        'max_connections': 20,
+        'keepalive_connections': 10,
+        'keepalive_expiry': 30,
+        'http2': False,
+    },
+    'game': {
+        # False for 80% of max_log_tokens
+        'summarize_at_tokens': False,
+        'chapter_tokens': 8000,
+        'max_chapters': 10,
+        'memory_tokens': 4000,
+        'queue_size': 5,
+        'queue_max_wait': 300,
+        'batch_window': 0,
+        'max_batch_size': 4,
+        'recent_tokens': False,
+        'fact_tokens': 1000,
+    },
+    'prompts': {
+        'chapter_instruction': "Please summarize the events above as a chapter of the adventure. Capture as much of the story as you can.",
+        'batch_instruction': "Several players acted at once. Your reply must respond to the actions of every one of these characters:",
+        'facts_instruction': "Things established earlier in the story that may matter now:",
+        'arc_instruction': "Please combine the chapters above into a single summary of the adventure so far. Keep the most important characters, places and events.",
+    },
+    'experimental': {
+        'image_generation': False,
+        'image_prefetch': False,
+        'max_concurrent_images': 1,
+        'image_cache_size': 50,
+    },
+    'metrics': {
+        'port': False,
+        'host': "127.0.0.1",
+        'prices': {},
+        'profile_sample_interval': 0.005,
+        'slow_callback_duration': 0.1,
+    },
+    'files': {
+        'journal_compact_every': 100,
+        'save_delay': 1.0,
+        'fsync': "snapshot",
+        'storage': "yaml",
+        'snapshot_format': "binary",
+        'database': "game.db",
+        'image_cache': "image_cache",
+        'world_index': "world_index.db",
+        'diagnostics_dir': "diagnostics",
+        'shard_state': "shard_state.db",
+        'backup_keep_last': 10,
+        'backup_keep_daily': 7,
+        'backup_keep_weekly': 4,
+    },
+}
+for section, values in defaults.items():
+    if not isinstance(config.get(section), dict):
+        config[section] = {}
+    for key, value in values.items():
+        config[section].setdefault(key, value)
+
 # Extract dice string
 if config['game']['dice']:
     try:
@@ -21,6 +100,57 @@ if config['game']['dice']:
         sys.exit(1)
     config['game']['dice'] = {'num_dice': num_dice, 'dice_type': dice_type}
 
-# Ensure discord IDs are ints
-config['discord']['channel_id'] = int(config['discord']['channel_id'])
+if config['files']['storage'] not in ("yaml", "sqlite"):
+    logger.fatal(f"Invalid storage: {config['files']['storage']}. Use yaml or sqlite. Exiting.")
+    sys.exit(1)
+
+if config['files']['fsync'] not in ("always", "snapshot", "never"):
+    logger.fatal(f"Invalid fsync: {config['files']['fsync']}. Use always, snapshot or never. Exiting.")
+    sys.exit(1)
+
+if config['files']['snapshot_format'] not in ("binary", "yaml"):
+    logger.fatal(f"Invalid snapshot_format: {config['files']['snapshot_format']}. Use binary or yaml. Exiting.")
+    sys.exit(1)
+
+# Summaries start in the background before the log is too long to send
+if not config['game']['summarize_at_tokens']:
+    config['game']['summarize_at_tokens'] = int(config['game']['max_log_tokens'] * 0.8)
+elif config['game']['summarize_at_tokens'] >= config['game']['max_log_tokens']:
+    logger.fatal(f"Invalid summarize_at_tokens: {config['game']['summarize_at_tokens']}. It must be lower than max_log_tokens ({config['game']['max_log_tokens']}). Exiting.")
+    sys.exit(1)
+
+# Seconds, or a percentile of recent request times like p95
+hedge_after = config['openai']['hedge_after']
+if not (hedge_after is None or hedge_after is False
+        or type(hedge_after) in (int, float) and hedge_after > 0
+        or isinstance(hedge_after, str) and re.fullmatch(r"p[1-9][0-9]?", hedge_after)):
+    logger.fatal(f"Invalid hedge_after: {hedge_after}. Use a number of seconds or a percentile like p95. Exiting.")
+    sys.exit(1)
+
+# Per call site overrides of base_url, api_key and max_concurrent_requests
+endpoints = config['openai']['endpoints'] or {}
+for call_site, settings in endpoints.items():
+    if call_site not in ("main", "summary", "image") or not isinstance(settings, dict) \
+            or not set(settings) <= {"base_url", "api_key", "max_concurrent_requests"}:
+        logger.fatal(f"Invalid endpoint: {call_site}. Use main, summary or image, with base_url, api_key and max_concurrent_requests. Exiting.")
+        sys.exit(1)
+config['openai']['endpoints'] = endpoints
+
+# false for one connection to Discord, "auto" or a number for several. shard_ids is
+# for running some of them in this process, and the rest in others.
+shard_count, shard_ids = config['discord']['shard_count'], config['discord']['shard_ids']
+if not (shard_count is False or shard_count is None or shard_count == "auto" or type(shard_count) is int and shard_count > 0):
+    logger.fatal(f"Invalid shard_count: {shard_count}. Use false, auto or a number. Exiting.")
+    sys.exit(1)
+if shard_ids and (type(shard_count) is not int or not isinstance(shard_ids, list)
+                  or not all(type(shard) is int and 0 <= shard < shard_count for shard in shard_ids)):
+    logger.fatal(f"Invalid shard_ids: {shard_ids}. Use a list of shards from 0 to shard_count - 1, with shard_count a number. Exiting.")
+    sys.exit(1)
+
+# Ensure discord IDs are ints. channel_id can be a single channel or a list, one
+# campaign is run in each channel.
+channel_ids = config['discord']['channel_id']
+if not isinstance(channel_ids, list):
+    channel_ids = [channel_ids]
+config['discord']['channel_ids'] = [int(channel_id) for channel_id in channel_ids]
 config['discord']['admin_ids'] = [int(admin_id) for admin_id in config['discord']['admin_ids']]
@@ -1,13 +1,12 @@
 import os
+import json
 import yaml
-import shutil
+import asyncio
 from datetime import datetime
 from logger import logger
 from config import config
-
-# Create the backup directory if it doesn't exist
-if not os.path.exists(config['files']['backup_dir']):
-    os.makedirs(config['files']['backup_dir'])
+import metrics
+import binary_snapshot
 
 def get_empty_context():
     return {
@@ -15,27 +14,278 @@ def get_empty_context():
         "characters": {},
         "log": [{"role": "system", "content": config['prompts']['base']}],
         "previous_users": [],
+        "memory": {"arc": "", "chapters": []},
         "token_usage": -1,
         "status": "Starting a new adventure!",
         "last_status_update": datetime.now()
     }
 
-def load_game_context():
-    if os.path.exists(config['files']['game']):
-        with open(config['files']['game'], 'r', encoding="utf-8") as f:
-            context = yaml.load(f, Loader=yaml.SafeLoader)
-        # Fill in missing fields with defaults
-        context = {**get_empty_context(), **context}
+class GameStore:
+    """
+    Saves and loads one campaign's game context.
+
+    Changes are appended to the journal as JSON lines, and periodically compacted
+    into a full snapshot at snapshot_path(). Each record has a sequence number,
+    and the snapshot stores the last sequence number it includes, so a crash between
+    writing a snapshot and clearing the journal can't apply a record twice.
+
+    Writes are queued and made by a background task, which waits files.save_delay
+    seconds after the first change so that several changes go out in one write.
+    Without the background task running, writes are made straight away.
+    """
+    def __init__(self, files):
+        self.files = files
+        self.snapshot_path = snapshot_path(files)
+        self.journal_path = files['game'] + ".journal"
+        self.journal_seq = 0
+        self.records_since_snapshot = 0
+        self.snapshot_exists = False
+        # Set when a write fails. What it held is lost, so the next save is a full snapshot.
+        self.write_failed = False
+        self.pending_snapshot = None    # (copy of the game context, journal_seq)
+        self.pending_lines = []
+        self.writer_task = None
+        self.writer_dirty = None
+        self.write_lock = None
+        self.persistence_stats = {"save_requests": 0, "writes": 0}
+
+    def load_game_context(self):
+        context, self.journal_seq, replayed, converted_path = self._read_game_context()
+        self.snapshot_exists = converted_path is not None or os.path.exists(self.snapshot_path)
+        self.records_since_snapshot = 0
+
+        # Compact straight away, so new records aren't appended after a torn one
+        if replayed:
+            logger.info(f"Replayed {replayed} journal records")
+        if replayed or converted_path:
+            self._write((context, self.journal_seq), [])
+            self.snapshot_exists = True
+        # Keep the original, but don't import it again
+        if converted_path:
+            os.replace(converted_path, converted_path + ".imported")
+            logger.info(f"Converted {converted_path} to {self.snapshot_path}, the original is kept as {converted_path}.imported")
+
         return context
 
-    return get_empty_context()
+    # Only reads the game context, for tools that mustn't change the files, such as
+    # migrate_to_sqlite.py. The journal is replayed in memory.
+    def read_game_context(self):
+        return self._read_game_context()[0]
 
-def save_game_context(game_context):
-    with open(config['files']['game'], 'w', encoding="utf-8") as f:
-        yaml.dump(game_context, f)
+    # Returns the game context, the last journal sequence number in it, how many
+    # journal records were replayed, and the file it was converted from if any
+    def _read_game_context(self):
+        context = get_empty_context()
+        journal_seq = 0
+        # A game saved in the other format: a YAML file from before binary snapshots or
+        # being imported, or a binary snapshot after files.snapshot_format was set to yaml
+        other_path = snapshot_path({**self.files, 'snapshot_format': "yaml" if self.files['snapshot_format'] == "binary" else "binary"})
+        converting = os.path.exists(other_path) and not os.path.exists(self.snapshot_path)
+        if converting or os.path.exists(self.snapshot_path):
+            saved_context, journal_seq = _read_snapshot(other_path if converting else self.snapshot_path)
+            # Fill in missing fields with defaults
+            context = {**context, **saved_context}
+
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r', encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line, object_hook=_json_object_hook)
+                    except json.JSONDecodeError:
+                        # A torn write from a crash, nothing after it can be trusted
+                        logger.warning(f"Ignoring incomplete record in {self.journal_path}")
+                        break
+                    if record["seq"] <= journal_seq:
+                        continue
+                    _apply_record(context, record)
+                    journal_seq = record["seq"]
+                    replayed += 1
+
+        return context, journal_seq, replayed, other_path if converting else None
+
+    # Loads in a thread, so the bot can carry on meanwhile
+    async def load_game_context_in_background(self):
+        return await asyncio.to_thread(self.load_game_context)
+
+    def save_game_context(self, game_context):
+        self.persistence_stats["save_requests"] += 1
+        # Copy now, the game context will keep changing while the write is pending
+        self.pending_snapshot = (_copy_context(game_context), self.journal_seq)
+        # The snapshot includes everything still waiting to go to the journal
+        self.pending_lines.clear()
+        self.records_since_snapshot = 0
+        self.snapshot_exists = True
+        self.write_failed = False
+        self._mark_dirty()
+
+    def journal_game_context(self, game_context, records):
+        if not records:
+            return
+        # Records are replayed on top of the snapshot, so there must be one, and it
+        # must include any records a failed write lost
+        if not self.snapshot_exists or self.write_failed:
+            self.save_game_context(game_context)
+            return
+
+        self.persistence_stats["save_requests"] += 1
+        for record in records:
+            self.journal_seq += 1
+            self.pending_lines.append(json.dumps({"seq": self.journal_seq, **record}, default=_json_default) + "\n")
+
+        self.records_since_snapshot += len(records)
+        if self.records_since_snapshot >= self.files['journal_compact_every']:
+            self.save_game_context(game_context)
+        else:
+            self._mark_dirty()
+
+    def _mark_dirty(self):
+        if self.writer_task is None:
+            self._write(*self._take_pending())
+        else:
+            self.writer_dirty.set()
+
+    def _take_pending(self):
+        snapshot, lines = self.pending_snapshot, self.pending_lines
+        self.pending_snapshot, self.pending_lines = None, []
+        return snapshot, lines
 
-def backup_game_context():
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_filename = os.path.join(config['files']['backup_dir'], f"{timestamp}.yaml")
-    shutil.copy(config['files']['game'], backup_filename)
-    logger.info(f"Backup created: {backup_filename}")
+    def _write(self, snapshot, lines):
+        if snapshot is None and not lines:
+            return
+        # Records after lost ones can't be replayed, the snapshot that's coming has them
+        if snapshot is None and self.write_failed:
+            return
+        try:
+            with metrics.timed("disk_write"):
+                self._write_files(snapshot, lines)
+        except Exception:
+            self.write_failed = True
+            raise
+        self.persistence_stats["writes"] += 1
+
+    def _write_files(self, snapshot, lines):
+        fsync = self.files['fsync']
+        if snapshot is not None:
+            context, seq = snapshot
+            # Write to a temporary file first, so a crash can't leave a half written snapshot
+            temp_filename = self.snapshot_path + ".tmp"
+            if self.files['snapshot_format'] == "binary":
+                with open(temp_filename, 'wb') as f:
+                    f.write(binary_snapshot.dumps(context, seq, _json_default))
+                    if fsync != "never":
+                        f.flush()
+                        os.fsync(f.fileno())
+            else:
+                with open(temp_filename, 'w', encoding="utf-8") as f:
+                    yaml.dump({**context, "journal_seq": seq}, f)
+                    if fsync != "never":
+                        f.flush()
+                        os.fsync(f.fileno())
+            os.replace(temp_filename, self.snapshot_path)
+            open(self.journal_path, 'w').close()
+        if lines:
+            with open(self.journal_path, 'a', encoding="utf-8") as f:
+                f.write("".join(lines))
+                if fsync == "always":
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    async def _write_in_background(self):
+        async with self.write_lock:
+            snapshot, lines = self._take_pending()
+            await asyncio.to_thread(self._write, snapshot, lines)
+
+    async def persistence_task(self):
+        while True:
+            await self.writer_dirty.wait()
+            await asyncio.sleep(self.files['save_delay'])
+            self.writer_dirty.clear()
+            # Keep going whatever went wrong, or nothing would be saved again
+            try:
+                await self._write_in_background()
+            except Exception as e:
+                logger.error(f"Failed to save game context, the next save will be a full snapshot. Error: {e}")
+
+    def start_persistence(self):
+        if self.writer_task is not None:
+            return
+        self.writer_dirty = asyncio.Event()
+        self.write_lock = asyncio.Lock()
+        self.writer_task = asyncio.create_task(self.persistence_task())
+        if self.pending_snapshot is not None or self.pending_lines:
+            self.writer_dirty.set()
+
+    # Write anything still pending, call before shutting down. If a write failed,
+    # game_context is saved in full.
+    async def flush_game_context(self, game_context=None):
+        if self.write_failed and game_context is not None:
+            self.save_game_context(game_context)
+        if self.writer_task is None:
+            self._write(*self._take_pending())
+        else:
+            await self._write_in_background()
+
+# files.game is the YAML game file. Binary snapshots go next to it, with a .snapshot extension.
+def snapshot_path(files):
+    if files['snapshot_format'] == "yaml":
+        return files['game']
+    return os.path.splitext(files['game'])[0] + ".snapshot"
+
+# Returns the game context and the journal sequence number it includes, from a
+# binary snapshot or a YAML file
+def _read_snapshot(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if binary_snapshot.is_snapshot(data):
+        return binary_snapshot.loads(data, _json_object_hook)
+    context = yaml.load(data, Loader=yaml.SafeLoader)
+    journal_seq = context.pop("journal_seq", 0)
+    return context, journal_seq
+
+def _copy_context(game_context):
+    return {
+        **game_context,
+        "characters": {user_id: dict(char) for user_id, char in game_context["characters"].items()},
+        "log": [dict(entry) for entry in game_context["log"]],
+        "previous_users": list(game_context["previous_users"]),
+        "memory": {**game_context["memory"], "chapters": list(game_context["memory"]["chapters"])},
+    }
+
+def _apply_record(context, record):
+    op = record["op"]
+    if op == "log_append":
+        context["log"].append(record["entry"])
+    elif op == "log_update":
+        context["log"][record["index"]] = record["entry"]
+    elif op == "log_pop":
+        context["log"].pop()
+    elif op == "log_prune_system":
+        if "positions" in record:
+            for position in reversed(record["positions"]):
+                del context["log"][position]
+        else:
+            # Journals written before positions were recorded
+            context["log"] = [entry for i, entry in enumerate(context["log"]) if entry["role"] != "system" or i == 0]
+    elif op == "character_set":
+        context["characters"][record["user_id"]] = record["character"]
+    elif op == "character_delete":
+        context["characters"].pop(record["user_id"], None)
+    elif op == "set":
+        context[record["key"]] = record["value"]
+    else:
+        raise ValueError(f"Unknown journal record: {op}")
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    raise TypeError(f"Can't journal {type(value).__name__}")
+
+def _json_object_hook(obj):
+    if "$datetime" in obj:
+        return datetime.fromisoformat(obj["$datetime"])
+    return obj
+
+def _write_backup(backup_filename, game_context):
+    with open(backup_filename, 'w', encoding="utf-8") as f:
+        yaml.dump(game_context, f)
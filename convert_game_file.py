@@ -0,0 +1,41 @@
+# Imports and exports game contexts as YAML, for files.snapshot_format: binary.
+# Usage: python convert_game_file.py config.yaml export [channel_id] [file.yaml]
+#        python convert_game_file.py config.yaml import (channel_id) (file.yaml)
+# Stop the bot first. The channel defaults to the first one in discord.channel_id,
+# and exports default to files.game with an .export.yaml extension.
+# Importing replaces the campaign's snapshot and journal, make a backup first.
+import os
+import sys
+import yaml
+from logger import logger
+from config import config
+from campaign import campaign_files
+from context import GameStore, get_empty_context, _write_backup
+
+if len(sys.argv) < 3 or sys.argv[2] not in ("export", "import"):
+    print("Usage: python convert_game_file.py config.yaml export [channel_id] [file.yaml]")
+    print("       python convert_game_file.py config.yaml import (channel_id) (file.yaml)")
+    sys.exit(1)
+command = sys.argv[2]
+channel_id = int(sys.argv[3]) if len(sys.argv) > 3 else config['discord']['channel_ids'][0]
+files = campaign_files(channel_id)
+store = GameStore(files)
+
+if command == "export":
+    yaml_filename = sys.argv[4] if len(sys.argv) > 4 else os.path.splitext(files['game'])[0] + ".export.yaml"
+    game_context = store.read_game_context()
+    _write_backup(yaml_filename, game_context)
+    logger.info(f"Exported channel {channel_id} to {yaml_filename}: {game_context['game_name']}, "
+                f"{len(game_context['characters'])} characters, {len(game_context['log'])} log entries")
+else:
+    if len(sys.argv) < 5:
+        print("Usage: python convert_game_file.py config.yaml import (channel_id) (file.yaml)")
+        sys.exit(1)
+    with open(sys.argv[4], 'r', encoding="utf-8") as f:
+        imported = yaml.load(f, Loader=yaml.SafeLoader)
+    imported.pop("journal_seq", None)
+    game_context = {**get_empty_context(), **imported}
+    # A fresh snapshot clears the journal
+    store.save_game_context(game_context)
+    logger.info(f"Imported {sys.argv[4]} into {store.snapshot_path}: {game_context['game_name']}, "
+                f"{len(game_context['characters'])} characters, {len(game_context['log'])} log entries")
@@ -1,21 +1,28 @@
+import re
+import asyncio
 import discord
 from logger import logger
 from config import config
+import metrics
+from outbox import get_outbox, REPLY
 
 intents = discord.Intents.default()
 intents.message_content = True
-client = discord.Client(intents=intents)
-
-public_channel = None
+if config['discord']['shard_count']:
+    # Several connections to Discord, each getting the events of some of the servers
+    client = discord.AutoShardedClient(
+        intents=intents,
+        shard_count=None if config['discord']['shard_count'] == "auto" else config['discord']['shard_count'],
+        shard_ids=config['discord']['shard_ids'] or None
+    )
+else:
+    client = discord.Client(intents=intents)
 
 current_details = None
 current_status = discord.Status.online
 
-def get_public_channel():
-    global public_channel
-    if public_channel is None:
-        public_channel = client.get_channel(config['discord']['channel_id'])
-    return public_channel
+def get_public_channel(campaign):
+    return client.get_channel(campaign.channel_id)
 
 async def set_activity_presence(details, is_idle=False):
     global current_details, current_status
@@ -36,34 +43,146 @@ async def set_activity_presence(details, is_idle=False):
     current_details = details
     current_status = status
 
-async def discord_safe_send(message, channel):
-    if len(message) <= config['discord']['message_length']:
-        await channel.send(message)
-        return
-
-    logger.info("AI message is too long, splitting into multiple messages. If this happens often, try reducing max_tokens")
-    message_chunks = chunk_string(message)
-    for chunk in message_chunks:
-        await channel.send(chunk)
-
+# Sends through the channel's outbox, returns once every part has been sent
+async def discord_safe_send(message, channel, priority=REPLY):
+    with metrics.timed("discord_send", kind="message"):
+        if len(message) > config['discord']['message_length']:
+            logger.info("AI message is too long, splitting into multiple messages. If this happens often, try reducing max_tokens")
+        outbox = get_outbox(channel)
+        results = await asyncio.gather(
+            *(outbox.send(chunk, priority) for chunk in chunk_string(message)),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+class StreamingMessage:
+    """
+    Posts a reply as soon as text arrives and edits it in place as more streams in.
+    Edits are rate limited to one per discord.stream_edit_interval seconds, and the
+    reply rolls over to a new message whenever it passes discord.message_length.
+    """
+    def __init__(self, channel, prefix=""):
+        self.channel = channel
+        self.prefix = prefix
+        self.text = ""
+        self.messages = []
+        self.sent_chunks = []
+        self.last_flush = 0
+        self.flush_task = None
+
+    def update(self, text):
+        self.text = text
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def finish(self, text):
+        self.text = text
+        if self.flush_task is not None:
+            await self.flush_task
+        await self._flush()
+
+    async def _flush_later(self):
+        delay = self.last_flush + config['discord']['stream_edit_interval'] - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            await self._flush()
+        except discord.HTTPException as e:
+            logger.warning(f"Failed to update streaming message. Error: {e}")
+
+    async def _flush(self):
+        self.last_flush = asyncio.get_running_loop().time()
+        chunks = chunk_string(self.prefix + self.text)
+        for i, chunk in enumerate(chunks):
+            if i >= len(self.messages):
+                with metrics.timed("discord_send", kind="stream_message"):
+                    # Not combined with other messages, as it will be edited
+                    self.messages.append(await get_outbox(self.channel).send(chunk, combine=False))
+                self.sent_chunks.append(chunk)
+            elif chunk != self.sent_chunks[i]:
+                with metrics.timed("discord_send", kind="stream_edit"):
+                    await self.messages[i].edit(content=chunk)
+                self.sent_chunks[i] = chunk
+        # The text can shrink if a request was retried part way through
+        while len(self.messages) > len(chunks):
+            await self.messages.pop().delete()
+            self.sent_chunks.pop()
+
+MARKDOWN_TOKENS = re.compile(r"```|`|\*\*|__|~~|\*")
+
+# Splits text into messages of at most discord.message_length characters. Splits at
+# paragraphs, then lines, then spaces, but not inside formatting like **bold**. A code
+# block that doesn't fit is closed at the end of one message and reopened in the next.
 def chunk_string(text):
+    limit = config['discord']['message_length']
     chunks = []
     while text:
-        if len(text) <= config['discord']['message_length']:
+        if len(text) <= limit:
             chunks.append(text)
             break
 
-        split_point = text.rfind('\n', 0, config['discord']['message_length'])
-        if split_point == -1:
-            split_point = text.rfind(' ', 0, config['discord']['message_length'])
-        
-        if split_point == -1:
-            split_point = config['discord']['message_length']
-
-        chunks.append(text[:split_point].rstrip())
-        text = text[split_point:].lstrip()
+        spans, fence_language = _markdown_spans(text)
+        chunk, text = _split_markdown(text, limit, spans, fence_language)
+        chunks.append(chunk)
 
     return chunks
 
-def client_close():
-    client.close()
+def _split_markdown(text, limit, spans, fence_language):
+    for separator in ("\n\n", "\n", " "):
+        split_point = text.rfind(separator, 0, limit)
+        while split_point > 0:
+            span = next((span for span in spans if span[0] < split_point < span[1]), None)
+            if span is None:
+                return text[:split_point].rstrip(), text[split_point:].lstrip()
+            # Split code blocks at line ends, closing and reopening the block. Not at the end
+            # of the opening line, or the rest would be as long as the text and never fit.
+            start, end, is_fence = span
+            if is_fence and separator != " " and split_point + 4 <= limit and split_point > text.find("\n", start):
+                return (text[:split_point].rstrip() + "\n```",
+                        "```" + fence_language[start] + "\n" + text[split_point:].lstrip("\n"))
+            split_point = text.rfind(separator, 0, split_point)
+
+    # Nowhere safe to split, so split the old way
+    split_point = text.rfind('\n', 0, limit)
+    if split_point == -1:
+        split_point = text.rfind(' ', 0, limit)
+    if split_point == -1:
+        split_point = limit
+    return text[:split_point].rstrip(), text[split_point:].lstrip()
+
+# Finds code blocks and inline formatting as (start, end, is_fence). Also returns the
+# language of each code block, by start position.
+def _markdown_spans(text):
+    spans = []
+    fence_language = {}
+    fence_start = code_start = None
+    open_markers = {}
+    for match in MARKDOWN_TOKENS.finditer(text):
+        token = match.group()
+        if fence_start is not None:
+            if token == "```":
+                spans.append((fence_start, match.end(), True))
+                fence_start = None
+        elif code_start is not None:
+            if token == "`":
+                spans.append((code_start, match.end(), False))
+                code_start = None
+        elif token == "```":
+            fence_start = match.start()
+            line_end = text.find("\n", match.end())
+            fence_language[fence_start] = text[match.end():line_end if line_end != -1 else len(text)].strip()
+        elif token == "`":
+            code_start = match.start()
+        elif token in open_markers:
+            spans.append((open_markers.pop(token), match.end(), False))
+        else:
+            open_markers[token] = match.start()
+    # A code block still open carries on to the end, stray markers are ignored
+    if fence_start is not None:
+        spans.append((fence_start, len(text), True))
+    return spans, fence_language
+
+async def client_close():
+    await client.close()
@@ -1,26 +1,40 @@
+import time
+import sqlite3
 import asyncio
 from logger import logger
 from random import randint
 from datetime import datetime
 from config import config
-from context import save_game_context, backup_game_context, load_game_context, get_empty_context
-from openai import OpenAI
-import adventure_log
+from context import get_empty_context
+from campaign import Campaign
+from tokens import message_tokens, entry_tokens
+import metrics
+import llm
+import images
 
-openai_client = OpenAI(api_key=config['openai']['api_key'])
+# One campaign per channel, by channel ID
+campaigns = {}
 
-game_lock = asyncio.Lock()
+# The reply when the storyteller couldn't be reached
+TECHNICAL_ISSUES = "I'm experiencing technical issues. Please try again later."
 
+def get_campaign(channel_id):
+    return campaigns.get(channel_id)
+
+# Functions taking a campaign as their first argument hold that campaign's lock.
+# Campaigns are locked separately, so a slow turn in one never blocks another.
 def locked():
     def decorator(func):
-        async def wrapper(*args, **kwargs):
-            async with game_lock:
-                return await func(*args, **kwargs)
+        async def wrapper(campaign, *args, **kwargs):
+            start = time.perf_counter()
+            async with campaign.lock:
+                metrics.observe("lock_wait", time.perf_counter() - start)
+                return await func(campaign, *args, **kwargs)
         return wrapper
     return decorator
 
-def is_game_locked():
-    return game_lock.locked()
+def is_game_locked(campaign):
+    return campaign.lock.locked()
 
 def roll_dice():
     if not config['game']['dice']:
@@ -28,22 +42,97 @@ def roll_dice():
     return [randint(1, config['game']['dice']['dice_type'])
             for _ in range(config['game']['dice']['num_dice'])]
 
-def _update_status(new_status):
-    game_context["status"] = new_status
-    game_context["last_status_update"] = datetime.now()
+def _record(campaign, op, **fields):
+    campaign.pending_changes.append({"op": op, **fields})
+
+def _set(campaign, key, value):
+    campaign.game_context[key] = value
+    _record(campaign, "set", key=key, value=value)
+
+def _new_entry(role, content):
+    return {"role": role, "content": content, "tokens": message_tokens(content)}
+
+# Rebuilds everything kept about the log, for when it's been replaced. Otherwise
+# it's kept up to date as entries are added and removed.
+def _index_log(campaign):
+    log = campaign.game_context["log"]
+    campaign.log_tokens = sum(entry_tokens(entry) for entry in log)
+    campaign.system_entries = [position for position in range(1, len(log)) if log[position]["role"] == "system"]
+    campaign.last_assistant = None
+    for position in range(len(log) - 1, 0, -1):
+        if log[position]["role"] == "assistant":
+            campaign.last_assistant = position
+            break
 
-def _build_system_prompt():
+def _log_append(campaign, role, content):
+    entry = _new_entry(role, content)
+    log = campaign.game_context["log"]
+    log.append(entry)
+    campaign.log_tokens += entry["tokens"]
+    if role == "system":
+        campaign.system_entries.append(len(log) - 1)
+    elif role == "assistant":
+        campaign.last_assistant = len(log) - 1
+    _record(campaign, "log_append", entry=dict(entry))
+
+def _log_pop(campaign):
+    entry = campaign.game_context["log"].pop()
+    campaign.log_tokens -= entry_tokens(entry)
+    if entry["role"] == "system":
+        campaign.system_entries.pop()
+    elif entry["role"] == "assistant":
+        _index_log(campaign)
+    _record(campaign, "log_pop")
+
+# Removes the system entries added since the last reply. They're all near the end
+# of the log, so this only moves the entries after them.
+def _log_prune_system(campaign):
+    log = campaign.game_context["log"]
+    for position in reversed(campaign.system_entries):
+        campaign.log_tokens -= entry_tokens(log[position])
+        del log[position]
+    _record(campaign, "log_prune_system", positions=campaign.system_entries)
+    campaign.system_entries = []
+
+def _update_system_prompt(campaign):
+    log = campaign.game_context["log"]
+    campaign.log_tokens -= entry_tokens(log[0])
+    log[0] = _new_entry("system", _build_system_prompt(campaign))
+    campaign.log_tokens += log[0]["tokens"]
+    _record(campaign, "log_update", index=0, entry=dict(log[0]))
+
+# Checked before a request is sent, so an oversized log is summarized first
+def is_over_token_budget(campaign, next_message=""):
+    needed = _prompt_tokens(campaign) + message_tokens(next_message) + config['openai']['max_tokens']
+    return needed > config['game']['max_log_tokens']
+
+def _save(campaign):
+    with metrics.timed("save", kind="journal"):
+        campaign.store.journal_game_context(campaign.game_context, campaign.pending_changes)
+    campaign.pending_changes.clear()
+
+# For changes that replace most of the game context, write a full snapshot instead
+def _save_snapshot(campaign):
+    campaign.pending_changes.clear()
+    with metrics.timed("save", kind="snapshot"):
+        campaign.store.save_game_context(campaign.game_context)
+
+def _update_status(campaign, new_status):
+    _set(campaign, "status", new_status)
+    _set(campaign, "last_status_update", datetime.now())
+
+def _build_system_prompt(campaign):
     character_descriptions = [
         f"{char['name']} is a {char['race']} {char['class']} ({char['pronouns']} pronouns), {char['appearance']}"
-        for char in game_context["characters"].values()
+        for char in campaign.game_context["characters"].values()
     ]
     return config['prompts']['base'] + "\nThe players are:\n" + "\n".join(character_descriptions)
 
 @locked()
 # user_id_or_name can be a integer user_id, a string user_id, or a string character name
-async def character_leaves(user_id_or_name, custom_message=None):
+async def character_leaves(campaign, user_id_or_name, custom_message=None):
     user_id_or_name = str(user_id_or_name).lower()
-    characters = game_context['characters']
+    characters = campaign.game_context['characters']
 
     # Resolve the user ID
     for user_id, char in characters.items():
@@ -52,21 +141,22 @@ async def character_leaves(user_id_or_name, custom_message=None):
     else:
         return f"⚠️ Character {user_id_or_name} not found."
     
-    character_name = game_context["characters"][user_id]["name"]
+    character_name = characters[user_id]["name"]
     generic_message = f"{character_name} has left the party."
     story_message = custom_message if custom_message else generic_message
     # Give ChatGPT both messages, to ensure it knows the character has left
     context_message = (custom_message + " " if custom_message else "") + generic_message
 
-    game_context["log"].append({"role": "system", "content": context_message})
-    del game_context["characters"][user_id]
-    _update_status(generic_message)
-    save_game_context(game_context)
-    adventure_log.add_action(story_message)
+    _log_append(campaign, "system", context_message)
+    del characters[user_id]
+    _record(campaign, "character_delete", user_id=user_id)
+    _update_status(campaign, generic_message)
+    _save(campaign)
+    campaign.adventure_log.add_action(story_message)
     return story_message
 
 @locked()
-async def create_character(user_id, name, race, pronouns, char_class, appearance):
+async def create_character(campaign, user_id, name, race, pronouns, char_class, appearance):
     # Check limits
     max_length = config['game']['max_lengths']
     if len(name) > max_length['name']:
@@ -88,7 +178,7 @@ async def create_character(user_id, name, race, pronouns, char_class, appearance
     if name.isnumeric():
         return "⚠️ Character name cannot be just a number. _I am not a number!_"
 
-    characters = game_context['characters']
+    characters = campaign.game_context['characters']
 
     # Check if the name is already in use (case insensitive)
     if any(char["name"].lower() == name.lower() for char in characters.values()):
@@ -101,7 +191,7 @@ async def create_character(user_id, name, race, pronouns, char_class, appearance
         old_char = characters[user_id]
         log_message = f"{old_char['name']}, the {old_char['race']} {old_char['class']} ({old_char['pronouns']}), has left the party. "
         return_message = f"{old_char['name']} has left the party.\n\n"
-        adventure_log.add_action(f"{old_char['name']} has left the party.")
+        campaign.adventure_log.add_action(f"{old_char['name']} has left the party.")
     else:
         log_message = return_message = ""
 
@@ -113,192 +203,462 @@ async def create_character(user_id, name, race, pronouns, char_class, appearance
         "class": char_class,
         "appearance": appearance
     }
+    _record(campaign, "character_set", user_id=user_id, character=dict(characters[user_id]))
     log_message += f"{name} has joined the party!"
-    game_context["log"].append({"role": "user", "content": log_message})
-    game_context["log"][0]["content"] = _build_system_prompt()
-    _update_status(log_message)
-    save_game_context(game_context)
+    _log_append(campaign, "user", log_message)
+    _update_system_prompt(campaign)
+    _update_status(campaign, log_message)
+    _save(campaign)
 
     arrival_message = f"{name} has joined the party! {name} is a {race} {char_class} ({pronouns}). Appearance: {appearance}."
-    adventure_log.add_action(arrival_message)
+    campaign.adventure_log.add_action(arrival_message)
     return return_message + arrival_message
 
-@locked()
-async def summarize_adventure():
-    backup_game_context()
-
-    summarise_log = game_context["log"].copy()
-    summarise_log[0]['content'] = config['prompts']['summary']
-    summarise_log.append({"role": "system", "content": config['prompts']['summary_instruction']})
+# Only one summary runs at a time, later callers wait for the one in progress
+async def summarize_adventure(campaign):
+    if campaign.summary_task is None or campaign.summary_task.done():
+        campaign.summary_task = asyncio.create_task(_summarize_adventure(campaign))
+    # Shielded, so a cancelled caller doesn't cancel the summary for everyone else
+    return await asyncio.shield(campaign.summary_task)
+
+def is_summary_running(campaign):
+    return campaign.summary_task is not None and not campaign.summary_task.done()
+
+# The soft limit, for starting a summary in the background before it's needed
+def is_over_summary_threshold(campaign):
+    return campaign.log_tokens > config['game']['summarize_at_tokens']
+
+# The story is remembered in tiers. The oldest part of the log, up to
+# game.chapter_tokens, is summarized once into a chapter. Once there are more than
+# game.max_chapters, the oldest chapters are rolled up into the arc. The arc and
+# as many recent chapters as fit in game.memory_tokens are sent with every request.
+# So each summary only ever sees a bounded amount of text, however long the game.
+def _update_memory_entry(campaign):
+    memory = campaign.game_context["memory"]
+    budget = config['game']['memory_tokens'] - message_tokens(memory["arc"])
+    chapters = []
+    for chapter in reversed(memory["chapters"]):
+        budget -= chapter["tokens"]
+        if budget < 0:
+            break
+        chapters.insert(0, chapter["content"])
+    parts = ([memory["arc"]] if memory["arc"] else []) + chapters
+    campaign.memory_entry = _new_entry("assistant", "\n\n".join(parts)) if parts else None
+
+# query is the message being answered. With game.recent_tokens, only the recent turns
+# are sent, along with facts from earlier in the story that are relevant to the query.
+def _build_messages(campaign, query=""):
+    log = campaign.game_context["log"]
+    memory = [campaign.memory_entry] if campaign.memory_entry else []
+    if not config['game']['recent_tokens']:
+        return log[:1] + memory + log[1:]
+
+    recent = _recent_entries(campaign)
+    facts = campaign.world_index.relevant_facts(
+        campaign.channel_id, campaign.game_context["game_name"], query, config['game']['fact_tokens'],
+        skip_text="\n".join(entry["content"] for entry in recent)
+    )
+    facts_entry = [_new_entry("system", config['prompts']['facts_instruction'] + "\n" + "\n".join(f"- {fact}" for fact in facts))] if facts else []
+    return log[:1] + memory + facts_entry + recent
+
+# The most recent log entries that fit in game.recent_tokens. Everything since the
+# last reply is always included.
+def _recent_entries(campaign):
+    log = campaign.game_context["log"]
+    current_turn = (campaign.last_assistant or 0) + 1
+    budget = config['game']['recent_tokens']
+    start = len(log)
+    while start > 1:
+        budget -= entry_tokens(log[start - 1])
+        if budget < 0 and start <= current_turn:
+            break
+        start -= 1
+    return log[start:]
+
+def _prompt_tokens(campaign):
+    memory_tokens = campaign.memory_entry["tokens"] if campaign.memory_entry else 0
+    if config['game']['recent_tokens']:
+        # However long the log gets, only the recent turns and some facts are sent
+        log_tokens = entry_tokens(campaign.game_context["log"][0]) + config['game']['recent_tokens'] + config['game']['fact_tokens']
+        return min(campaign.log_tokens, log_tokens) + memory_tokens
+    return campaign.log_tokens + memory_tokens
+
+# Adds the names and quests in text to the world index, see world_index.py
+def _index_facts(campaign, text):
+    if campaign.world_index is None:
+        return
+    character_names = [character["name"] for character in campaign.game_context["characters"].values()]
+    # The index is shared with other processes, a busy database mustn't lose the turn
+    try:
+        campaign.world_index.add_text(campaign.channel_id, campaign.game_context["game_name"], text, character_names)
+    except sqlite3.Error as e:
+        logger.error(f"Failed to add facts to the world index. Error: {e}")
+
+# For games played before game.recent_tokens was turned on
+def _catch_up_facts(campaign):
+    if campaign.world_index is None:
+        return
+    try:
+        if campaign.world_index.has_facts(campaign.channel_id, campaign.game_context["game_name"]):
+            return
+    except sqlite3.Error as e:
+        logger.error(f"Failed to read the world index. Error: {e}")
+        return
+    memory = campaign.game_context["memory"]
+    for text in [memory["arc"]] + [chapter["content"] for chapter in memory["chapters"]]:
+        _index_facts(campaign, text)
+    for entry in campaign.game_context["log"]:
+        if entry["role"] == "assistant":
+            _index_facts(campaign, entry["content"])
 
+# last_assistant is the position of the last assistant entry in the log
+def _next_chapter(log, last_assistant):
+    # Never summarize the last assistant message or anything after it
+    if last_assistant is not None and last_assistant > 1:
+        end = last_assistant
+    else:
+        end = len(log) - 1
+    # Take the oldest entries that fit in a chapter, ending on an assistant message if possible
+    chapter = []
+    chapter_tokens = 0
+    for entry in log[1:end]:
+        chapter_tokens += entry_tokens(entry)
+        if chapter and chapter_tokens > config['game']['chapter_tokens']:
+            break
+        chapter.append(entry)
+    for last in range(len(chapter) - 1, 0, -1):
+        if chapter[last]["role"] == "assistant":
+            return chapter[:last + 1]
+    return chapter
+
+async def _summarize(campaign, messages, instruction):
+    messages = [{"role": "system", "content": config['prompts']['summary']}] + messages
+    messages.append({"role": "system", "content": instruction})
+    _update_status(campaign, "Storyteller is thinking...")
     try:
-        summary_text, _ = await _get_chatgpt_response(
-            config['openai']['summary_model'],
-            summarise_log,
+        summary_text, _ = await llm.get_response(
+            "summary",
+            messages,
             config['openai']['max_summary_tokens'],
             config['openai']['summary_temperature']
         )
     except Exception as e:
         logger.error(f"Summarization process failed. Error: {e}")
         return False
-    
-    # Start a new log begining with the summary
-    new_log = [
-        {"role": "system", "content": _build_system_prompt()},
-        {"role": "assistant", "content": summary_text},
-    ]
-    # Add the last assistant message and all messages after it
-    for entry in reversed(game_context["log"]):
-        if entry["role"] == "assistant":
-            new_log.extend(reversed(game_context["log"][game_context["log"].index(entry):]))
-            break
+    return summary_text
 
-    game_context["log"] = new_log
-    game_context["token_usage"] = -1
-    
-    _update_status("The story so far...")
-    save_game_context(game_context)
+# The game lock is only held while picking what to summarize and while swapping the
+# summary in, so play carries on while the summary model is working.
+async def _summarize_adventure(campaign):
+    async with campaign.lock:
+        summarised_context = campaign.game_context
+        chapter = _next_chapter(summarised_context["log"], campaign.last_assistant)
+        context_entry = campaign.memory_entry
+    if not chapter:
+        return False
+    await campaign.backups.backup_game_context(summarised_context)
+
+    summary_text = await _summarize(campaign, ([context_entry] if context_entry else []) + chapter, config['prompts']['chapter_instruction'])
+    if summary_text == False:
+        return False
+
+    async with campaign.lock:
+        game_context = campaign.game_context
+        # A new game was started while we were summarizing
+        if game_context is not summarised_context:
+            return False
+
+        # Entries added while the summary was being written are kept
+        summarised_ids = {id(entry) for entry in chapter}
+        game_context["log"] = [entry for entry in game_context["log"] if id(entry) not in summarised_ids]
+        game_context["memory"]["chapters"].append({"content": summary_text, "tokens": message_tokens(summary_text)})
+        game_context["token_usage"] = -1
+        _index_log(campaign)
+        _update_memory_entry(campaign)
+
+        _update_status(campaign, "The story so far...")
+        _save_snapshot(campaign)
+        chapters_to_roll = len(game_context["memory"]["chapters"]) - config['game']['max_chapters']
+
+    if chapters_to_roll > 0:
+        await _roll_up_arc(campaign, summarised_context, max(chapters_to_roll, config['game']['max_chapters'] // 2))
     return summary_text
 
+async def _roll_up_arc(campaign, summarised_context, num_chapters):
+    memory = summarised_context["memory"]
+    arc, chapters = memory["arc"], memory["chapters"][:num_chapters]
+    messages = ([{"role": "assistant", "content": arc}] if arc else [])
+    messages += [{"role": "assistant", "content": chapter["content"]} for chapter in chapters]
+    arc_text = await _summarize(campaign, messages, config['prompts']['arc_instruction'])
+    if arc_text == False:
+        return
+
+    async with campaign.lock:
+        if campaign.game_context is not summarised_context:
+            return
+        memory["arc"] = arc_text
+        del memory["chapters"][:num_chapters]
+        _update_memory_entry(campaign)
+        _save_snapshot(campaign)
+
 @locked()
-async def respond_to_admin(message):
-    assistant_reply = await _respond_and_log(message, role="system")
-    _update_status("The story was moved forward...")
-    save_game_context(game_context)
-    adventure_log.add_storyteller(assistant_reply)
+async def respond_to_admin(campaign, message, on_text=None):
+    assistant_reply = await _respond_and_log(campaign, message, role="system", on_text=on_text)
+    if assistant_reply is None:
+        return TECHNICAL_ISSUES
+    _update_status(campaign, "The story was moved forward...")
+    _save(campaign)
+    campaign.adventure_log.add_storyteller(assistant_reply)
     return assistant_reply
 
-@locked()
-async def respond_to_player(user_id, message, dice_values = None):
-    # Update the previous users list
-    if config['game']['max_previous_users'] > 0:
-        game_context["previous_users"].append(user_id)
-        if len(game_context["previous_users"]) > config['game']['max_previous_users']:
-            game_context["previous_users"].pop(0)
-
-    character_name = game_context["characters"][user_id]["name"]
-    if dice_values:
-        message += f" [{sum(dice_values)}]"
-    assistant_reply = await _respond_and_log(f"{character_name}: {message}")
-    _update_status(f"{character_name} made a decision...")
-    save_game_context(game_context)
-    adventure_log.add_quote(character_name, message)
-    adventure_log.add_storyteller(assistant_reply)
+# on_text is an optional callback, called with the reply so far as it streams in
+async def respond_to_player(campaign, user_id, message, dice_values = None, on_text = None):
+    assistant_reply, _ = await respond_to_players(campaign, [(user_id, message, dice_values)], on_text)
     return assistant_reply
 
-async def _respond_and_log(message, role = "user"):
-    game_context["log"].append({"role": role, "content": message})
+@locked()
+# actions is a list of (user_id, message, dice_values), all answered in one reply.
+# Returns the reply, None if no action was left, and the user IDs of the actions
+# skipped because their character had left the game.
+async def respond_to_players(campaign, actions, on_text = None):
+    game_context = campaign.game_context
+    # A character can leave, or a new game start, while the actions wait for the lock
+    skipped = [user_id for user_id, _, _ in actions if user_id not in game_context["characters"]]
+    actions = [action for action in actions if action[0] not in skipped]
+    if not actions:
+        return None, skipped
+
+    character_names = []
+    messages = []
+    for user_id, message, dice_values in actions:
+        character_names.append(game_context["characters"][user_id]["name"])
+        if dice_values:
+            message += f" [{sum(dice_values)}]"
+        messages.append(message)
+
+    # Make sure the storyteller answers everyone
+    instruction = config['prompts']['batch_instruction'] + " " + ", ".join(character_names) if len(actions) > 1 else None
+    player_turn = "\n".join(f"{name}: {message}" for name, message in zip(character_names, messages))
+    assistant_reply = await _respond_and_log(campaign, player_turn, on_text=on_text, instruction=instruction)
+    if assistant_reply is None:
+        return TECHNICAL_ISSUES, skipped
+
+    # Only turns that were answered count towards the previous users
+    if config['game']['max_previous_users'] > 0:
+        previous_users = game_context["previous_users"] + [user_id for user_id, _, _ in actions]
+        _set(campaign, "previous_users", previous_users[-config['game']['max_previous_users']:])
+    if len(actions) > 1:
+        _update_status(campaign, f"{', '.join(character_names[:-1])} and {character_names[-1]} made decisions...")
+    else:
+        _update_status(campaign, f"{character_names[0]} made a decision...")
+    _save(campaign)
+    for name, message in zip(character_names, messages):
+        campaign.adventure_log.add_quote(name, message)
+    campaign.adventure_log.add_storyteller(assistant_reply)
+    return assistant_reply, skipped
+
+# Returns the reply, or None if the request failed. instruction is a system entry
+# sent before message, which is removed along with it if the request fails.
+async def _respond_and_log(campaign, message, role = "user", on_text = None, instruction = None):
+    game_context = campaign.game_context
+    if instruction:
+        _log_append(campaign, "system", instruction)
+    _log_append(campaign, role, message)
+    messages = _build_messages(campaign, message)
+    prompt_tokens = sum(entry_tokens(entry) for entry in messages)
+    _update_status(campaign, "Storyteller is thinking...")
     try:
-        assistant_reply, token_usage = await _get_chatgpt_response(
-            config['openai']['main_model'],
-            game_context["log"],
+        assistant_reply, token_usage = await llm.get_response(
+            "main",
+            messages,
             config['openai']['max_tokens'],
-            config['openai']['main_temperature']
+            config['openai']['main_temperature'],
+            on_text
         )
     except Exception:
-        game_context["log"].pop()   # Remove the unprocessed message
-        return "I'm experiencing technical issues. Please try again later."
+        _log_pop(campaign)   # Remove the unprocessed message
+        if instruction:
+            _log_pop(campaign)
+        return None
     
     # Removes all entries with the role "system" from the game context log, except for the base prompt (entry 0).
-    game_context["log"] = [entry for i, entry in enumerate(game_context["log"]) if entry["role"] != "system" or i == 0]
-    game_context["log"].append({"role": "assistant", "content": assistant_reply})
-    game_context["token_usage"] = token_usage
+    _log_prune_system(campaign)
+    _log_append(campaign, "assistant", assistant_reply)
+    _index_facts(campaign, assistant_reply)
+    _set(campaign, "token_usage", token_usage)
+    campaign.last_estimated_usage = prompt_tokens + game_context["log"][-1]["tokens"]
     
     return assistant_reply
 
-async def _get_chatgpt_response(model, messages, max_tokens, temperature = 1.0):
-    _update_status("Storyteller is thinking...")
-    for attempt in range(config['openai']['max_attempts']):
-        try:
-            response = openai_client.chat.completions.create(
-                model=model,
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=temperature
-            )
-            return response.choices[0].message.content, response.usage.total_tokens
-        except Exception as e:
-            if attempt < config['openai']['max_attempts'] - 1:
-                logger.warning(f"ChatGPT request failed. Error: {e}. (Attempt #{attempt+1}.)")
-                await asyncio.sleep(config['openai']['retry_delay'] * (2**attempt))
-            else:
-                logger.error(f"ChatGPT request failed. Error: {e}. (Attempt #{attempt+1}.)")
-                raise
-
 @locked()
-async def player_say(user_id, user_message):
-    character_name = game_context["characters"][user_id]["name"]
-    game_context["log"].append({"role": "user", "content": f"{character_name} says: {user_message}"})
-    _update_status(f"{character_name} has spoken...")
-    save_game_context(game_context)
-    adventure_log.add_quote(f"{character_name} says", user_message)
+async def player_say(campaign, user_id, user_message):
+    character_name = campaign.game_context["characters"][user_id]["name"]
+    _log_append(campaign, "user", f"{character_name} says: {user_message}")
+    _update_status(campaign, f"{character_name} has spoken...")
+    _save(campaign)
+    campaign.adventure_log.add_quote(f"{character_name} says", user_message)
 
 @locked()
-async def admin_nudge(user_message):
-    game_context["log"].append({"role": "system", "content": user_message})
-    save_game_context(game_context)
+async def admin_nudge(campaign, user_message):
+    _log_append(campaign, "system", user_message)
+    _save(campaign)
 
 @locked()
-async def write_story(user_message):
-    game_context["log"].append({"role": "assistant", "content": user_message})
-    _update_status("The story was moved forward...")
-    save_game_context(game_context)
-    adventure_log.add_storyteller(user_message)
-
-def _update_context_from_config():
-    game_context["log"][0]["content"] = _build_system_prompt()
+async def write_story(campaign, user_message):
+    _log_append(campaign, "assistant", user_message)
+    _index_facts(campaign, user_message)
+    _update_status(campaign, "The story was moved forward...")
+    _save(campaign)
+    campaign.adventure_log.add_storyteller(user_message)
+
+def _update_context_from_config(campaign):
+    game_context = campaign.game_context
+    game_context["log"][0] = _new_entry("system", _build_system_prompt(campaign))
     if config['game']['max_previous_users'] < 1:
         game_context["previous_users"] = []
     else:
         game_context["previous_users"] = game_context["previous_users"][config['game']['max_previous_users']:]
 
 @locked()
-async def clear_previous_users():
-    game_context["previous_users"] = []
-    save_game_context(game_context)
+async def clear_previous_users(campaign):
+    _set(campaign, "previous_users", [])
+    _save(campaign)
 
 @locked()
-async def new_adventure(name=None):
-    backup_game_context()
-    game_context = get_empty_context()
+async def new_adventure(campaign, name=None):
+    await campaign.backups.backup_game_context(campaign.game_context)
+    campaign.game_context = get_empty_context()
     if name:
-        game_context["game_name"] = name
-    save_game_context(game_context)
-    adventure_log.set_log_name(game_context["game_name"])
+        campaign.game_context["game_name"] = name
+    if campaign.world_index:
+        # Not facts from an earlier game with the same name
+        try:
+            campaign.world_index.clear(campaign.channel_id, campaign.game_context["game_name"])
+        except sqlite3.Error as e:
+            logger.error(f"Failed to clear the world index. Error: {e}")
+    _index_log(campaign)
+    _update_memory_entry(campaign)
+    _save_snapshot(campaign)
+    campaign.adventure_log.set_log_name(campaign.game_context["game_name"])
+
+# Replaces the game with a backup, after backing up the current game.
+# Raises KeyError if there's no such backup.
+@locked()
+async def restore_backup(campaign, backup_name):
+    restored = await campaign.backups.load_backup(backup_name)
+    await campaign.backups.backup_game_context(campaign.game_context)
+    # Fill in missing fields with defaults
+    campaign.game_context = {**get_empty_context(), **restored}
+    _update_context_from_config(campaign)
+    _index_log(campaign)
+    _update_memory_entry(campaign)
+    _catch_up_facts(campaign)
+    _save_snapshot(campaign)
+    campaign.adventure_log.set_log_name(campaign.game_context["game_name"])
+    return campaign.game_context["game_name"]
 
 @locked()
-async def rename_adventure(new_name):
-    game_context["game_name"] = new_name
-    save_game_context(game_context)
-    adventure_log.rename_log(new_name)
-
-def players_until_turn(user_id):
-    if user_id in game_context["previous_users"]:
-        return config['game']['max_previous_users'] - game_context["previous_users"].index(user_id)
+async def rename_adventure(campaign, new_name):
+    if campaign.world_index:
+        try:
+            campaign.world_index.rename(campaign.channel_id, campaign.game_context["game_name"], new_name)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to rename the game in the world index. Error: {e}")
+    _set(campaign, "game_name", new_name)
+    _save(campaign)
+    campaign.adventure_log.rename_log(new_name)
+
+# queued_users are players with actions waiting, who will have taken their turns first
+def players_until_turn(campaign, user_id, queued_users=()):
+    previous_users = campaign.game_context["previous_users"] + list(queued_users)
+    if config['game']['max_previous_users'] < 1:
+        return 0
+    previous_users = previous_users[-config['game']['max_previous_users']:]
+    if user_id in previous_users:
+        return config['game']['max_previous_users'] - previous_users.index(user_id)
     return 0
 
 # Experimental feature
-async def generate_image_from_scene():
+def _image_params(campaign):
     # Find the last assistant message in the log
-    for entry in reversed(game_context["log"]):
-        if entry["role"] == "assistant":
-            break
-    else:
-        return False
-    
+    if campaign.last_assistant is None:
+        return None
+    entry = campaign.game_context["log"][campaign.last_assistant]
+
+    # Copy, so the config keeps its prompt_length for next time
+    params = dict(config['experimental']['image_generation'])
+    description_crop_length = params.pop('prompt_length') - len(params['prompt']) - 2
+    params['prompt'] = entry["content"][:description_crop_length] + ". " + params['prompt']
+    return params
+
+# Returns the path of the image file, or False if it failed
+async def generate_image_from_scene(campaign):
     try:
-        params = config['experimental']['image_generation']
-        description_crop_length = params['prompt_length'] - len(params['prompt']) - 2
-        del params['prompt_length']
-        params['prompt'] = entry["content"][:description_crop_length] + ". " + params['prompt']
-        response = openai_client.images.generate(**params)
-        return response.data[0].url
+        params = _image_params(campaign)
+        if params is None:
+            return False
+        return await images.get_image(llm.endpoints["image"], params)
     except Exception as e:
         logger.error(f"Image generation failed. Error: {e}")
         return False
 
-## Load the game context
-game_context = load_game_context()
-_update_context_from_config()
-adventure_log.set_log_name(game_context["game_name"])
-logger.info(f"Game context loaded: {game_context['game_name']}")
+# With experimental.image_prefetch, start on the picture for the latest scene straight away
+def prefetch_scene_image(campaign):
+    if not (config['experimental']['image_generation'] and config['experimental']['image_prefetch']):
+        return
+    # A broken image_generation setting mustn't get in the way of the turn
+    try:
+        params = _image_params(campaign)
+    except Exception as e:
+        logger.warning(f"Image prefetch failed. Error: {e}")
+        return
+    if params is not None:
+        images.prefetch_image(llm.endpoints["image"], params)
+
+def start_persistence():
+    for campaign in campaigns.values():
+        campaign.store.start_persistence()
+        campaign.adventure_log.start_writer()
+
+# Write anything still pending for every campaign, call before shutting down
+async def flush_game_contexts():
+    for campaign in campaigns.values():
+        await campaign.store.flush_game_context(campaign.game_context)
+        campaign.adventure_log.flush()
+
+async def _load_campaign(campaign):
+    campaign.game_context = await campaign.store.load_game_context_in_background()
+    _update_context_from_config(campaign)
+    _index_log(campaign)
+    _update_memory_entry(campaign)
+    _catch_up_facts(campaign)
+    # Only for campaigns this process runs, workers share the search index
+    campaign.adventure_log.catch_up_index()
+    campaign.adventure_log.set_log_name(campaign.game_context["game_name"])
+    logger.info(f"Game context loaded for channel {campaign.channel_id}: {campaign.game_context['game_name']}")
+
+async def _load_campaigns():
+    start = time.perf_counter()
+    await asyncio.gather(*(_load_campaign(campaign) for campaign in campaigns.values()))
+    logger.info(f"Loaded {len(campaigns)} game contexts in {time.perf_counter() - start:.2f} seconds")
+
+# For worker processes, which only run some of the campaigns, see shards.py.
+# Must be called before load_campaigns().
+def keep_campaigns(channel_ids):
+    for channel_id in list(campaigns):
+        if channel_id not in channel_ids:
+            del campaigns[channel_id]
+
+loading_task = None
+
+# Loads every campaign's game context. The first call starts loading, so the bot can
+# connect to Discord meanwhile, and anything that needs a game context awaits this.
+async def load_campaigns():
+    global loading_task
+    if loading_task is None:
+        loading_task = asyncio.create_task(_load_campaigns())
+    await asyncio.shield(loading_task)
+
+## Create the campaigns, their game contexts are loaded by load_campaigns()
+for channel_id in config['discord']['channel_ids']:
+    campaigns[channel_id] = Campaign(channel_id)
@@ -0,0 +1,73 @@
+import os
+import json
+import base64
+import hashlib
+import asyncio
+import aiohttp
+from logger import logger
+from config import config
+
+# Limit how many images are generated at once. Image requests also take a slot from
+# their endpoint's max_concurrent_requests, like every other request to it.
+image_semaphore = asyncio.Semaphore(config['experimental']['max_concurrent_images'])
+# Images being generated, by cache key. A second request for the same image waits for the first.
+jobs = {}
+
+def _cache_path(params):
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    return key, os.path.join(config['files']['image_cache'], f"{key}.png")
+
+# Returns the path of the image for params, the parameters for the create image API.
+# endpoint is the llm.Endpoint to send the request to.
+# Images are cached, so asking again for the same scene is instant.
+async def get_image(endpoint, params):
+    key, path = _cache_path(params)
+    if os.path.exists(path):
+        # Recently used images are kept longest
+        os.utime(path)
+        return path
+    if key not in jobs:
+        jobs[key] = asyncio.create_task(_generate(endpoint, params, path))
+        jobs[key].add_done_callback(lambda task: jobs.pop(key, None))
+    # Don't cancel the job if this caller gives up, someone else may be waiting for it
+    return await asyncio.shield(jobs[key])
+
+# Starts generating an image in the background, so it's ready when it's asked for
+def prefetch_image(endpoint, params):
+    task = asyncio.create_task(get_image(endpoint, params))
+    task.add_done_callback(_log_prefetch_error)
+
+def _log_prefetch_error(task):
+    if not task.cancelled() and task.exception():
+        logger.warning(f"Image prefetch failed. Error: {task.exception()}")
+
+async def _generate(endpoint, params, path):
+    async with image_semaphore, endpoint.semaphore:
+        response = await endpoint.client.images.generate(**params)
+    image = response.data[0]
+    if image.b64_json:
+        image_bytes = base64.b64decode(image.b64_json)
+    else:
+        # Image URLs expire, so keep a copy
+        async with aiohttp.ClientSession() as session:
+            async with session.get(image.url) as download:
+                download.raise_for_status()
+                image_bytes = await download.read()
+    await asyncio.to_thread(_save_image, path, image_bytes)
+    return path
+
+def _save_image(path, image_bytes):
+    cache_dir = os.path.dirname(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(image_bytes)
+    os.replace(temp_path, path)
+
+    # Remove the oldest images once there are too many
+    cached = sorted(
+        (os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".png")),
+        key=os.path.getmtime
+    )
+    for old_path in cached[:-config['experimental']['image_cache_size']]:
+        os.remove(old_path)
@@ -0,0 +1,286 @@
+import time
+import asyncio
+from collections import deque
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from logger import logger
+from config import config
+import metrics
+
+# The HTTP library the openai package is built on
+try:
+    import httpx2 as httpx
+except ImportError:
+    import httpx
+
+# One connection pool for every endpoint, so connections are kept open and reused
+# between requests instead of being set up again each time
+http_client = DefaultAsyncHttpxClient(
+    http2=config['openai']['http2'],
+    limits=httpx.Limits(
+        max_connections=config['openai']['max_connections'],
+        max_keepalive_connections=config['openai']['keepalive_connections'],
+        keepalive_expiry=config['openai']['keepalive_expiry']
+    )
+)
+
+class Endpoint:
+    """
+    An OpenAI compatible API, with its own limit on requests in flight.
+    Call sites configured with the same address, key and limit share one.
+    """
+    def __init__(self, base_url, api_key, max_concurrent_requests):
+        self.base_url = base_url
+        # We handle retries ourselves in get_response
+        self.client = AsyncOpenAI(
+            # Local servers often don't need a key, but the client insists on one
+            api_key=api_key or "none",
+            base_url=base_url,
+            timeout=config['openai']['request_timeout'],
+            max_retries=0,
+            http_client=http_client
+        )
+        self.semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+# By call site: main, summary or image
+endpoints = {}
+
+def _make_endpoints():
+    shared = {}
+    for call_site in ("main", "summary", "image"):
+        settings = config['openai']['endpoints'].get(call_site) or {}
+        key = tuple(settings.get(name, config['openai'][name]) for name in ("base_url", "api_key", "max_concurrent_requests"))
+        if key not in shared:
+            shared[key] = Endpoint(*key)
+        endpoints[call_site] = shared[key]
+
+_make_endpoints()
+
+# Recent time to first text of successful requests, by (model, streamed), for openai.hedge_after
+LATENCY_SAMPLES = 200
+MIN_LATENCY_SAMPLES = 20
+latencies = {}
+
+class CircuitBreaker:
+    """
+    Opens after openai.breaker_failures failures in a row, and the model is skipped
+    for openai.breaker_cooldown seconds. After that the model is tried again, and
+    one more failure opens the breaker again straight away.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.failures = 0
+        self.open_until = 0.0
+
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if config['openai']['breaker_failures'] and self.failures >= config['openai']['breaker_failures']:
+            if not self.is_open():
+                logger.warning(f"{self.model} failed {self.failures} times in a row, avoiding it for {config['openai']['breaker_cooldown']} seconds.")
+                metrics.increment("llm_breaker_opened", model=self.model)
+            self.open_until = time.monotonic() + config['openai']['breaker_cooldown']
+
+# By model
+breakers = {}
+
+def _breaker(model):
+    if model not in breakers:
+        breakers[model] = CircuitBreaker(model)
+    return breakers[model]
+
+# call_site is "main" or "summary". The first model is preferred, the rest are fallbacks.
+def _models(call_site):
+    return [config['openai'][f'{call_site}_model']] + config['openai'][f'{call_site}_fallback_models']
+
+# The model for the next request: the one after previous in the list, skipping models
+# whose breaker is open. Stays on the last model once the list runs out.
+def _pick_model(models, previous=None):
+    available = [model for model in models if not _breaker(model).is_open()]
+    if not available:
+        # Every breaker is open, try the one that will close first
+        return min(models, key=lambda model: _breaker(model).open_until)
+    if previous is None:
+        return available[0]
+    later = [model for model in available if models.index(model) > models.index(previous)]
+    if later:
+        return later[0]
+    return previous if previous in available else available[-1]
+
+# Seconds to wait for the first reply before sending the same request again, or None
+def _hedge_delay(model, streamed):
+    hedge_after = config['openai']['hedge_after']
+    if not hedge_after:
+        return None
+    if not isinstance(hedge_after, str):
+        return hedge_after
+    samples = latencies.get((model, streamed))
+    if not samples or len(samples) < MIN_LATENCY_SAMPLES:
+        return None
+    samples = sorted(samples)
+    percentile = int(hedge_after[1:])
+    return samples[min(len(samples) - 1, len(samples) * percentile // 100)]
+
+def _record_latency(model, streamed, seconds):
+    key = (model, streamed)
+    if key not in latencies:
+        latencies[key] = deque(maxlen=LATENCY_SAMPLES)
+    latencies[key].append(seconds)
+
+# Returns the reply and the total tokens used.
+# Failed requests are retried up to openai.max_attempts times, moving on to the call
+# site's fallback models. With openai.hedge_after, a slow request is raced against a
+# second one and the first to answer is used.
+# on_text is an optional callback, called with the reply so far as it streams in.
+async def get_response(call_site, messages, max_tokens, temperature = 1.0, on_text = None):
+    with metrics.timed("prompt_assembly"):
+        messages = _api_messages(messages)
+    endpoint = endpoints[call_site]
+    models = _models(call_site)
+    streamed = on_text is not None
+    pending = {}    # task -> (model, path)
+    shown = []      # The streaming task whose text is being shown, once there is one
+    attempts = 0
+    hedged = False
+    hedge_at = None
+    model = None
+    error = None
+
+    def start(model, path):
+        task = None
+        def show_text(text):
+            # Once one request starts showing text, the others are cancelled
+            if not shown:
+                shown.append(task)
+                for other in pending:
+                    if other is not task:
+                        other.cancel()
+            if shown[0] is task:
+                on_text(text)
+        task = asyncio.create_task(_attempt(endpoint, model, path, messages, max_tokens, temperature, show_text if streamed else None))
+        pending[task] = (model, path)
+
+    try:
+        while True:
+            if not pending:
+                if attempts >= config['openai']['max_attempts']:
+                    logger.error(f"ChatGPT request failed. Error: {error}. (Attempt #{attempts}.)")
+                    metrics.increment("llm_failures", model=model)
+                    raise error
+                previous = model
+                model = _pick_model(models, previous)
+                if attempts:
+                    logger.warning(f"ChatGPT request failed. Error: {error}. (Attempt #{attempts}.)")
+                    metrics.increment("llm_retries", model=previous)
+                    # A fallback model is tried straight away
+                    if model == previous:
+                        await asyncio.sleep(config['openai']['retry_delay'] * (2**(attempts - 1)))
+                start(model, "first" if not attempts else "retry")
+                attempts += 1
+                if not hedged:
+                    delay = _hedge_delay(model, streamed)
+                    hedge_at = None if delay is None else time.monotonic() + delay
+
+            timeout = None
+            if hedge_at is not None and not hedged and not shown:
+                timeout = max(0, hedge_at - time.monotonic())
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                hedged = True
+                # Only hedge with spare capacity, otherwise it slows everyone else down
+                if not endpoint.semaphore.locked():
+                    model = _pick_model(models, model)
+                    metrics.increment("llm_hedges", model=model)
+                    start(model, "hedge")
+                continue
+
+            for task in done:
+                task_model, path = pending.pop(task)
+                if task.cancelled():
+                    continue
+                if task.exception() is not None:
+                    error = task.exception()
+                    _breaker(task_model).record_failure()
+                    if shown and shown[0] is task:
+                        # Let the retry show its text from the start
+                        shown.clear()
+                    continue
+                _breaker(task_model).record_success()
+                metrics.increment("llm_served", call_site=call_site, model=task_model, path=path)
+                return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def _attempt(endpoint, model, path, messages, max_tokens, temperature, on_text):
+    start = time.perf_counter()
+    first_text = []
+    def show_text(text):
+        if not first_text:
+            first_text.append(True)
+            _record_latency(model, True, time.perf_counter() - start)
+        on_text(text)
+
+    try:
+        if on_text is not None:
+            result = await _openai_request(endpoint, _stream_chatgpt_response(
+                endpoint.client,
+                show_text,
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature
+            ))
+        else:
+            response = await _openai_request(endpoint, endpoint.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature
+            ))
+            _record_latency(model, False, time.perf_counter() - start)
+            metrics.record_usage(model, response.usage)
+            result = response.choices[0].message.content, response.usage.total_tokens
+    except asyncio.CancelledError:
+        # Lost a hedged race, or the turn was cancelled
+        raise
+    except Exception:
+        metrics.observe("llm_request", time.perf_counter() - start, model=model, path=path)
+        raise
+    metrics.observe("llm_request", time.perf_counter() - start, model=model, path=path)
+    return result
+
+# Log entries carry extra fields, like the token count, that the API doesn't accept
+def _api_messages(log):
+    return [{"role": entry["role"], "content": entry["content"]} for entry in log]
+
+async def _stream_chatgpt_response(openai_client, on_text, **params):
+    stream = await openai_client.chat.completions.create(
+        **params,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    text = ""
+    token_usage = -1
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            text += chunk.choices[0].delta.content
+            on_text(text)
+        # Usage is sent in a final chunk with no choices
+        if chunk.usage:
+            token_usage = chunk.usage.total_tokens
+            metrics.record_usage(params["model"], chunk.usage)
+    return text, token_usage
+
+async def _openai_request(endpoint, request):
+    # Waits for a free slot, then runs the request with a timeout. The request is
+    # cancelled if it times out or if the calling task is cancelled.
+    start = time.perf_counter()
+    async with endpoint.semaphore:
+        metrics.observe("llm_slot_wait", time.perf_counter() - start)
+        return await asyncio.wait_for(request, config['openai']['request_timeout'])
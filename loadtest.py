@@ -0,0 +1,328 @@
+# Offline load test. Simulated players play through storyteller.on_message against
+# mock_openai.py and a fake Discord channel, nothing is sent to Discord or OpenAI.
+#   python loadtest.py config.yaml [--players 8] [--actions 10] [--json results.jsonl]
+# The config file must come first. Game files are written to a temporary directory.
+# With --workers, the campaigns are split between worker processes by shard, as with
+# discord.shard_ids, and a fake gateway gives each worker the messages for its shards.
+# The workers share one directory, like workers on one machine share their files.
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from types import SimpleNamespace
+
+parser = argparse.ArgumentParser(description="Load test the storyteller with simulated players and a mock OpenAI API")
+parser.add_argument("config", help="Config file, its OpenAI and Discord settings are replaced")
+parser.add_argument("--campaigns", type=int, default=1, help="Campaigns to run at once")
+parser.add_argument("--players", type=int, default=4, help="Players in each campaign")
+parser.add_argument("--actions", type=int, default=10, help="Messages each player sends")
+parser.add_argument("--say-ratio", type=float, default=0.2, help="Fraction of messages that are !say")
+parser.add_argument("--think-time", type=float, default=2.0, help="Average seconds between a player's messages")
+parser.add_argument("--latency", type=float, default=1.0, help="Mock API seconds before each reply starts")
+parser.add_argument("--jitter", type=float, default=0.5, help="Mock API extra latency, up to this many seconds")
+parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of mock API requests that fail")
+parser.add_argument("--reply-words", type=int, default=120, help="Length of mock API replies")
+parser.add_argument("--stream", action="store_true", help="Stream replies (discord.stream_replies)")
+parser.add_argument("--discord-latency", type=float, default=0.0, help="Seconds each fake Discord call takes")
+parser.add_argument("--summarize-at", type=int, help="Override game.summarize_at_tokens to exercise summarization")
+parser.add_argument("--workers", type=int, default=1, help="Worker processes, each running the campaigns of one shard")
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--json", help="Append the results to this file as one JSON line")
+# Set for the worker processes started by --workers
+parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+# config.py reads the config file named in sys.argv[1]
+from config import config
+from mock_openai import MockOpenAI
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# The OpenAI client and the campaigns are set up when game_logic is imported
+mock_port = _free_port()
+config['openai']['base_url'] = f"http://127.0.0.1:{mock_port}/v1"
+config['openai']['api_key'] = "mock"
+config['openai']['endpoints'] = {}
+config['openai']['retry_delay'] = min(config['openai']['retry_delay'], 0.5)
+config['discord']['channel_ids'] = [1000 + i for i in range(args.campaigns)]
+if args.worker is not None:
+    config['discord']['shard_count'] = args.workers
+    config['discord']['shard_ids'] = [args.worker]
+config['discord']['stream_replies'] = args.stream
+config['discord']['idle_timeout'] = False
+if args.summarize_at:
+    config['game']['summarize_at_tokens'] = args.summarize_at
+if args.json:
+    args.json = os.path.abspath(args.json)
+launch_dir = os.getcwd()
+os.chdir(args.work_dir or tempfile.mkdtemp(prefix="storyteller_loadtest_"))
+
+import game_logic as game
+import storyteller
+import shards
+
+metrics = SimpleNamespace(
+    turn_latency=[], lock_wait=[], loop_lag=[], persistence=[],
+    messages=0, actions=0, rejections={}, bot_messages=0, edits=0,
+)
+
+class TimedLock(asyncio.Lock):
+    async def acquire(self):
+        start = time.monotonic()
+        result = await super().acquire()
+        metrics.lock_wait.append(time.monotonic() - start)
+        return result
+
+def _time_calls(obj, name, samples):
+    original = getattr(obj, name)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+    setattr(obj, name, timed)
+
+handle_player_actions = storyteller.handle_player_actions
+async def timed_handle_player_actions(campaign, actions):
+    await handle_player_actions(campaign, actions)
+    now = time.monotonic()
+    metrics.turn_latency.extend(now - action.queued_at for action in actions)
+storyteller.handle_player_actions = timed_handle_player_actions
+
+# Fake Discord
+class FakeTyping:
+    async def __aenter__(self):
+        pass
+    async def __aexit__(self, *exc):
+        pass
+
+class FakeSentMessage:
+    async def edit(self, **kwargs):
+        metrics.edits += 1
+        await asyncio.sleep(args.discord_latency)
+    async def delete(self):
+        await asyncio.sleep(args.discord_latency)
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        # Each campaign in a server of its own
+        self.guild = SimpleNamespace(id=channel_id << 22)
+    def typing(self):
+        return FakeTyping()
+    async def send(self, content=None, **kwargs):
+        metrics.bot_messages += 1
+        await asyncio.sleep(args.discord_latency)
+        return FakeSentMessage()
+
+class FakeMessage:
+    def __init__(self, user_id, content, channel):
+        self.author = SimpleNamespace(id=user_id)
+        self.content = content
+        self.channel = channel
+        self.guild = channel.guild
+        self.mentions = []
+    async def reply(self, content):
+        # Players only get replies when something went wrong, e.g. it's not their turn
+        reason = content.split(".")[0]
+        metrics.rejections[reason] = metrics.rejections.get(reason, 0) + 1
+        await asyncio.sleep(args.discord_latency)
+    async def add_reaction(self, emoji):
+        await asyncio.sleep(args.discord_latency)
+    async def remove_reaction(self, emoji, member):
+        await asyncio.sleep(args.discord_latency)
+
+class FakeGateway:
+    """Gives a worker the messages from the servers in its shards, like Discord does"""
+    def __init__(self, shard_ids, shard_count):
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+
+    def has_channel(self, channel):
+        return shards.shard_id(channel.guild.id, self.shard_count) in self.shard_ids
+
+    async def dispatch(self, message):
+        if self.has_channel(message.channel):
+            await storyteller.on_message(message)
+
+async def player(gateway, channel, user_id, rng):
+    await gateway.dispatch(FakeMessage(user_id, f"!newcharacter Player {user_id}, human, fighter, they, travel worn", channel))
+    for i in range(args.actions):
+        await asyncio.sleep(rng.expovariate(1 / args.think_time) if args.think_time else 0)
+        metrics.messages += 1
+        if rng.random() < args.say_ratio:
+            content = f"!say Keep watch, I'll be back before {rng.choice(['dawn', 'dusk', 'noon'])}."
+        else:
+            metrics.actions += 1
+            content = f"I {rng.choice(['search', 'climb', 'question', 'guard', 'follow'])} the {rng.choice(['tower', 'stranger', 'cellar', 'river', 'gate'])}, attempt {i}."
+        await gateway.dispatch(FakeMessage(user_id, content, channel))
+
+async def watch_loop_lag(interval=0.05):
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        metrics.loop_lag.append(time.monotonic() - start - interval)
+
+def _busy():
+    return any(campaign.action_queue.actions or campaign.action_queue.current for campaign in game.campaigns.values()) \
+        or storyteller.background_summary_tasks
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+    return {"p50": round(pick(50), 4), "p95": round(pick(95), 4), "p99": round(pick(99), 4), "max": round(samples[-1], 4)}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+async def main():
+    mock = MockOpenAI(args.latency, args.jitter, args.fail_rate, args.reply_words)
+    await mock.start(mock_port)
+    storyteller.client.loop = asyncio.get_running_loop()
+    storyteller.create_action_queues()
+    channels = [FakeChannel(channel_id) for channel_id in config['discord']['channel_ids']]
+    if args.worker is not None:
+        gateway = FakeGateway([args.worker], args.workers)
+        await storyteller.start_worker([channel.id for channel in channels if gateway.has_channel(channel)])
+    else:
+        gateway = FakeGateway([0], 1)
+        storyteller.campaigns_claimed.set()
+        await game.load_campaigns()
+        game.start_persistence()
+    for campaign in game.campaigns.values():
+        campaign.lock = TimedLock()
+        store_methods = ["_write"] if hasattr(campaign.store, "_write") else ["journal_game_context", "save_game_context"]
+        for name in store_methods:
+            _time_calls(campaign.store, name, metrics.persistence)
+    lag_task = asyncio.create_task(watch_loop_lag())
+
+    rng = random.Random(args.seed)
+    start = time.monotonic()
+    # Every worker makes the same players, but only plays those in its own campaigns
+    players = [(channel, channel.id * 100 + i, random.Random(rng.random())) for channel in channels for i in range(args.players)]
+    await asyncio.gather(*(
+        player(gateway, channel, user_id, player_rng)
+        for channel, user_id, player_rng in players
+        if gateway.has_channel(channel)
+    ))
+    while _busy():
+        await asyncio.sleep(0.05)
+    duration = time.monotonic() - start
+    flush_start = time.perf_counter()
+    await game.flush_game_contexts()
+    flush_time = time.perf_counter() - flush_start
+    lag_task.cancel()
+    await mock.stop()
+
+    rejected = sum(metrics.rejections.values())
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {key: value for key, value in vars(args).items() if key not in ("config", "json")},
+        "duration": round(duration, 2),
+        "turns": len(metrics.turn_latency),
+        "turns_per_second": round(len(metrics.turn_latency) / duration, 2) if duration else None,
+        "turn_latency": percentiles(metrics.turn_latency),
+        "lock_wait": percentiles(metrics.lock_wait),
+        "loop_lag": percentiles(metrics.loop_lag),
+        "messages": metrics.messages,
+        "actions": metrics.actions,
+        "rejected": rejected,
+        "rejection_rate": round(rejected / metrics.messages, 4) if metrics.messages else 0,
+        "rejections": metrics.rejections,
+        "requests": mock.stats["requests"],
+        "failed_requests": mock.stats["failures"],
+        "prompt_tokens": mock.stats["prompt_tokens"],
+        "completion_tokens": mock.stats["completion_tokens"],
+        "bot_messages": metrics.bot_messages,
+        "edits": metrics.edits,
+        "persistence": {"writes": len(metrics.persistence), "seconds": round(sum(metrics.persistence), 4), **(percentiles(metrics.persistence) or {})},
+        "flush_seconds": round(flush_time, 4),
+        # For combining the results of several workers
+        **({"samples": {"turn_latency": metrics.turn_latency, "lock_wait": metrics.lock_wait, "loop_lag": metrics.loop_lag}}
+           if args.worker is not None else {}),
+    }
+
+def _add_counts(total, counts):
+    for key, value in counts.items():
+        total[key] = total.get(key, 0) + value
+
+# Runs a worker process for each shard at once, and combines their results
+def run_workers():
+    # The workers use this process's temporary directory
+    work_dir = os.getcwd()
+    results_path = os.path.join(work_dir, "workers.jsonl")
+    open(results_path, "w").close()
+    start = time.monotonic()
+    # The later --json replaces any given to this process
+    workers = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--worker", str(worker), "--json", results_path, "--work-dir", work_dir],
+                         cwd=launch_dir, stdout=subprocess.DEVNULL)
+        for worker in range(args.workers)
+    ]
+    if any(worker.wait() for worker in workers):
+        sys.exit("A worker process failed")
+    wall_time = time.monotonic() - start
+    with open(results_path, encoding="utf-8") as f:
+        worker_results = [json.loads(line) for line in f]
+
+    samples = {key: [sample for result in worker_results for sample in result["samples"][key]] for key in worker_results[0]["samples"]}
+    totals = {key: sum(result[key] for result in worker_results)
+              for key in ("turns", "messages", "actions", "rejected", "failed_requests", "prompt_tokens", "completion_tokens", "bot_messages", "edits")}
+    rejections, requests = {}, {}
+    for result in worker_results:
+        _add_counts(rejections, result["rejections"])
+        _add_counts(requests, result["requests"])
+    # The workers run side by side, so the slowest one decides how long it all takes
+    duration = max(result["duration"] for result in worker_results)
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {key: value for key, value in vars(args).items() if key not in ("config", "json", "worker")},
+        "duration": duration,
+        "wall_time": round(wall_time, 2),
+        "turns": totals["turns"],
+        "turns_per_second": round(totals["turns"] / duration, 2) if duration else None,
+        "worker_turns": [result["turns"] for result in worker_results],
+        "turn_latency": percentiles(samples["turn_latency"]),
+        "lock_wait": percentiles(samples["lock_wait"]),
+        "loop_lag": percentiles(samples["loop_lag"]),
+        "messages": totals["messages"],
+        "actions": totals["actions"],
+        "rejected": totals["rejected"],
+        "rejection_rate": round(totals["rejected"] / totals["messages"], 4) if totals["messages"] else 0,
+        "rejections": rejections,
+        "requests": requests,
+        "failed_requests": totals["failed_requests"],
+        "prompt_tokens": totals["prompt_tokens"],
+        "completion_tokens": totals["completion_tokens"],
+        "bot_messages": totals["bot_messages"],
+        "edits": totals["edits"],
+    }
+
+if args.workers > 1 and args.worker is None:
+    results = run_workers()
+else:
+    results = asyncio.run(main())
+for key, value in results.items():
+    print(f"{key:>18}: {json.dumps(value)}")
+if args.json:
+    with open(args.json, "a", encoding="utf-8") as f:
+        f.write(json.dumps(results) + "\n")
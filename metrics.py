@@ -0,0 +1,149 @@
+import time
+import bisect
+from contextlib import contextmanager
+from aiohttp import web
+from logger import logger
+from config import config
+
+# Histogram bucket upper bounds in seconds, from disk writes up to slow LLM replies
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+DESCRIPTIONS = {
+    "turn": "From a player's action being queued to the reply being sent",
+    "queue_wait": "Time player actions waited in the action queue",
+    "lock_wait": "Time spent waiting for a campaign's game lock",
+    "prompt_assembly": "Time to build the messages sent to the API",
+    "llm_slot_wait": "Time waiting for a free OpenAI request slot",
+    "llm_request": "OpenAI request time, by model and path (first, retry or hedge)",
+    "save": "Time to save the game context, by kind",
+    "disk_write": "Time writing game files in the background",
+    "adventure_log_write": "Time writing the adventure log",
+    "discord_send": "Time sending messages to Discord, by kind",
+    "llm_retries": "OpenAI requests that failed and were retried",
+    "llm_failures": "OpenAI requests that failed on every attempt",
+    "llm_served": "Replies, by call site, the model that answered and path (first, retry or hedge)",
+    "llm_hedges": "Second requests sent because the first was slow",
+    "llm_breaker_opened": "Times a model was avoided after failing repeatedly",
+    "tokens": "Tokens used, by model and kind",
+    "cost_dollars": "Estimated cost in US dollars, by model, from metrics.prices",
+}
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Upper bound of the bucket the quantile falls in
+    def quantile(self, q):
+        running = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            running += count
+            if running >= q * self.count:
+                return bound
+        return BUCKETS[-1]
+
+# Keyed by (name, labels), labels is a tuple of (label, value) pairs
+histograms = {}
+counters = {}
+server = None
+
+def _key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    if key not in histograms:
+        histograms[key] = Histogram()
+    histograms[key].observe(seconds)
+
+def increment(name, amount=1, **labels):
+    key = _key(name, labels)
+    counters[key] = counters.get(key, 0) + amount
+
+@contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+# usage is the usage from an OpenAI response
+def record_usage(model, usage):
+    # Some OpenAI compatible APIs don't report usage
+    if usage is None:
+        return
+    increment("tokens", usage.prompt_tokens, model=model, kind="prompt")
+    increment("tokens", usage.completion_tokens, model=model, kind="completion")
+    prices = config['metrics']['prices'].get(model)
+    if prices:
+        cost = (usage.prompt_tokens * prices['prompt'] + usage.completion_tokens * prices['completion']) / 1_000_000
+        increment("cost_dollars", cost, model=model)
+
+def _format_labels(labels, extra=()):
+    labels = labels + extra
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+def render_prometheus():
+    lines = []
+    described = set()
+    for (name, labels), histogram in sorted(histograms.items()):
+        metric = f"storyteller_{name}_seconds"
+        if name not in described:
+            described.add(name)
+            lines += [f"# HELP {metric} {DESCRIPTIONS.get(name, name)}", f"# TYPE {metric} histogram"]
+        running = 0
+        for bound, count in zip(BUCKETS, histogram.counts):
+            running += count
+            lines.append(f"{metric}_bucket{_format_labels(labels, (('le', '+Inf' if bound == float('inf') else str(bound)),))} {running}")
+        lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.sum}")
+        lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+    for (name, labels), value in sorted(counters.items()):
+        metric = f"storyteller_{name}_total"
+        if name not in described:
+            described.add(name)
+            lines += [f"# HELP {metric} {DESCRIPTIONS.get(name, name)}", f"# TYPE {metric} counter"]
+        lines.append(f"{metric}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+# For !stats, one line for each histogram and counter
+def stats_lines():
+    lines = []
+    for (name, labels), histogram in sorted(histograms.items()):
+        lines.append(
+            f"{_stat_name(name, labels)}: {histogram.count}×, "
+            f"avg {histogram.sum / histogram.count * 1000:.0f}ms, p95 ≤ {_format_bound(histogram.quantile(0.95))}"
+        )
+    for (name, labels), value in sorted(counters.items()):
+        lines.append(f"{_stat_name(name, labels)}: {value:.4g}" if isinstance(value, float) else f"{_stat_name(name, labels)}: {value}")
+    return lines
+
+def _stat_name(name, labels):
+    return " ".join([name] + [value for _, value in labels])
+
+def _format_bound(bound):
+    if bound == float("inf"):
+        return "∞"
+    return f"{bound * 1000:.0f}ms" if bound < 1 else f"{bound:g}s"
+
+async def _metrics_handler(request):
+    return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    global server
+    if not config['metrics']['port'] or server is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    server = web.AppRunner(app)
+    await server.setup()
+    await web.TCPSite(server, config['metrics']['host'], config['metrics']['port']).start()
+    logger.info(f"Serving metrics on http://{config['metrics']['host']}:{config['metrics']['port']}/metrics")
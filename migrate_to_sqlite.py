@@ -0,0 +1,28 @@
+# Copies each campaign's game context from its game file (and journal) into files.database.
+# The game files aren't changed.
+# Usage: python migrate_to_sqlite.py [config.yaml]
+# Campaigns already in the database are skipped. Set files.storage to sqlite afterwards.
+import os
+from logger import logger
+from config import config
+from campaign import campaign_files
+from context import GameStore, snapshot_path
+from sqlite_store import SqliteStore
+
+for channel_id in config['discord']['channel_ids']:
+    files = campaign_files(channel_id)
+    game_files = (files['game'], snapshot_path({**files, 'snapshot_format': "binary"}), files['game'] + ".journal")
+    if not any(os.path.exists(path) for path in game_files):
+        logger.info(f"No game file for channel {channel_id}, skipping")
+        continue
+
+    sqlite_store = SqliteStore(files, channel_id)
+    if sqlite_store.db.execute("SELECT 1 FROM campaigns WHERE channel_id = ?", (channel_id,)).fetchone():
+        logger.info(f"Channel {channel_id} is already in {files['database']}, skipping")
+        continue
+
+    # Read-only, so the game files are left as they were if the migration is abandoned
+    game_context = GameStore(files).read_game_context()
+    sqlite_store.save_game_context(game_context)
+    logger.info(f"Migrated {files['game']} to {files['database']}: {game_context['game_name']}, "
+                f"{len(game_context['characters'])} characters, {len(game_context['log'])} log entries")
@@ -0,0 +1,98 @@
+# A stand-in for OpenAI's chat completions API, for load testing without an API key.
+# Used by loadtest.py, or run on its own and point openai.base_url at it:
+#   python mock_openai.py [--port 8080] [--latency 1.0] [--fail-rate 0.05]
+import json
+import time
+import random
+import asyncio
+import argparse
+from aiohttp import web
+
+WORDS = "the party presses on through the mist as distant bells ring and something stirs in the dark".split()
+
+class MockOpenAI:
+    """
+    Answers /v1/chat/completions with filler text, streamed or not, after latency
+    plus up to jitter seconds. fail_rate of requests fail with a 500 error instead.
+    """
+    def __init__(self, latency=1.0, jitter=0.5, fail_rate=0.0, reply_words=120, stream_interval=0.05):
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.reply_words = reply_words
+        self.stream_interval = stream_interval
+        self.stats = {"requests": {}, "failures": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.runner = None
+
+    async def start(self, port=0):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        return f"http://127.0.0.1:{port}/v1"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def chat_completions(self, request):
+        params = await request.json()
+        model = params.get("model", "")
+        self.stats["requests"][model] = self.stats["requests"].get(model, 0) + 1
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if random.random() < self.fail_rate:
+            self.stats["failures"] += 1
+            return web.json_response({"error": {"message": "Injected failure", "type": "server_error"}}, status=500)
+
+        # Roughly what tokens.py estimates without tiktoken
+        prompt_tokens = sum(len(message["content"]) // 4 + 5 for message in params["messages"])
+        words = [random.choice(WORDS) for _ in range(min(self.reply_words, params.get("max_tokens") or self.reply_words))]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["completion_tokens"] += len(words)
+        completion = {"id": "chatcmpl-mock", "created": int(time.time()), "model": model}
+
+        if not params.get("stream"):
+            return web.json_response({
+                **completion,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i in range(0, len(words), 5):
+            text = " ".join(words[i:i + 5]) + " "
+            chunk = {**completion, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(self.stream_interval)
+        if params.get("stream_options", {}).get("include_usage"):
+            chunk = {**completion, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+async def serve(args):
+    mock = MockOpenAI(args.latency, args.jitter, args.fail_rate, args.reply_words)
+    base_url = await mock.start(args.port)
+    print(f"Mock OpenAI API at {base_url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(json.dumps(mock.stats))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock OpenAI chat completions API")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=1.0, help="Seconds before each reply starts")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Up to this many extra seconds, at random")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--reply-words", type=int, default=120)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,96 @@
+import heapq
+import asyncio
+import itertools
+from logger import logger
+from config import config
+
+# Lower numbers are sent first
+REPLY = 0       # The story, and anything else players are waiting to read
+MESSAGE = 1     # Other messages, like characters joining
+REACTION = 2    # Dice, queue positions and acknowledgements
+
+class Outbox:
+    """
+    Sends one channel's messages and reactions one at a time, most important first,
+    so reactions never hold up the story. Items with the same priority go in order.
+
+    Messages waiting to be sent are combined, up to discord.message_length, so
+    they take fewer requests. While discord.py waits out a rate limit, more
+    messages build up and get combined.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.queue = []     # heap of (priority, order, action, args, combine, future)
+        self.order = itertools.count()
+        self.worker_task = None
+
+    # Returns a future for the sent message. combine=False for messages that will be edited.
+    def send(self, content, priority=REPLY, combine=True):
+        return self._put(priority, "send", (content,), combine)
+
+    def add_reaction(self, message, emoji):
+        return self._put(REACTION, "add_reaction", (message, emoji))
+
+    def remove_reaction(self, message, emoji, member):
+        return self._put(REACTION, "remove_reaction", (message, emoji, member))
+
+    def _put(self, priority, action, args, combine=False):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.order), action, args, combine, future))
+        if self.worker_task is None:
+            self.worker_task = asyncio.create_task(self._worker())
+        return future
+
+    def _take_combined(self, priority, content, futures):
+        while self.queue:
+            next_priority, _, action, args, combine, future = self.queue[0]
+            if next_priority != priority or action != "send" or not combine:
+                break
+            combined = content + "\n\n" + args[0]
+            if len(combined) > config['discord']['message_length']:
+                break
+            heapq.heappop(self.queue)
+            content = combined
+            futures.append(future)
+        return content
+
+    async def _worker(self):
+        try:
+            while self.queue:
+                priority, _, action, args, combine, future = heapq.heappop(self.queue)
+                futures = [future]
+                if action == "send" and combine:
+                    args = (self._take_combined(priority, args[0], futures),)
+                try:
+                    if action == "send":
+                        result = await self.channel.send(*args)
+                    elif action == "add_reaction":
+                        result = await args[0].add_reaction(args[1])
+                    else:
+                        result = await args[0].remove_reaction(args[1], args[2])
+                except Exception as e:
+                    logger.warning(f"Failed to {action.replace('_', ' ')} in channel {self.channel.id}. Error: {e}")
+                    # Reactions aren't waited for, so the error is only logged
+                    _resolve(futures, error=e if action == "send" else None)
+                else:
+                    _resolve(futures, result)
+        finally:
+            self.worker_task = None
+
+def _resolve(futures, result=None, error=None):
+    for future in futures:
+        # The sender may have stopped waiting
+        if future.done():
+            continue
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+# One outbox for each channel, by channel ID
+outboxes = {}
+
+def get_outbox(channel):
+    if channel.id not in outboxes:
+        outboxes[channel.id] = Outbox(channel)
+    return outboxes[channel.id]
@@ -0,0 +1,184 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from logger import logger
+from config import config
+
+# Nothing here runs until an admin starts a profile, so there's no cost otherwise.
+# While it runs:
+# - a thread samples every thread's stack every metrics.profile_sample_interval seconds,
+# - tracemalloc records where memory is allocated,
+# - a task measures how late the event loop wakes up,
+# - every callback the event loop runs is timed, to find any slower than metrics.slow_callback_duration.
+
+MAX_SECONDS = 600
+TRACEMALLOC_FRAMES = 10
+SUMMARY_LINES = 5
+REPORT_LINES = 40
+LAG_INTERVAL = 0.05
+# Where a thread with nothing to do waits. Samples there aren't counted as CPU time.
+IDLE_FRAMES = {("select", "selectors.py"), ("wait", "threading.py"), ("_worker", "thread.py"), ("get", "queue.py")}
+
+# The profile in progress
+active = None
+untimed_run = asyncio.Handle._run
+
+class Profile:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.stopped = asyncio.Event()
+        self.sampler_done = threading.Event()
+        self.stacks = Counter()     # Folded stack -> samples
+        self.samples = 0
+        self.idle_samples = 0
+        self.lags = []
+        self.slow_callbacks = []
+
+    async def run(self):
+        started = datetime.now()
+        start = time.perf_counter()
+
+        sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        sampler.start()
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        memory_before = tracemalloc.take_snapshot()
+        lag_task = asyncio.create_task(self._watch_loop_lag())
+        # asyncio's debug mode also reports slow callbacks, but it records a stack
+        # trace for every callback, which would swamp the CPU profile
+        asyncio.Handle._run = _timed_run
+
+        try:
+            await asyncio.wait_for(self.stopped.wait(), self.seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            asyncio.Handle._run = untimed_run
+            lag_task.cancel()
+            memory_after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self.sampler_done.set()
+            await asyncio.to_thread(sampler.join)
+
+        duration = time.perf_counter() - start
+        # Leave out the profiler's own allocations
+        own_files = [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+        memory_diff = memory_after.filter_traces(own_files).compare_to(memory_before.filter_traces(own_files), "lineno")
+        return await asyncio.to_thread(self._write_report, started, duration, memory_diff)
+
+    def _sample(self):
+        interval = config['metrics']['profile_sample_interval']
+        own_id = threading.get_ident()
+        thread_names = {}
+        while not self.sampler_done.wait(interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if thread_id not in thread_names:
+                    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                code = frame.f_code
+                if (code.co_name, os.path.basename(code.co_filename)) in IDLE_FRAMES:
+                    self.idle_samples += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    async def _watch_loop_lag(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lags.append(time.perf_counter() - start - LAG_INTERVAL)
+
+    # Writes the report and the stacks, and returns a summary for Discord
+    def _write_report(self, started, duration, memory_diff):
+        directory = config['files']['diagnostics_dir']
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.join(directory, "profile_" + started.strftime("%Y%m%d_%H%M%S"))
+
+        # Folded stacks, the input format of flamegraph.pl and speedscope
+        with open(name + ".folded", "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        own_samples, total_samples = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            if len(frames) > 1:
+                own_samples[frames[-1]] += count
+            for frame in set(frames[1:]):
+                total_samples[frame] += count
+        samples = max(self.samples, 1)
+        lags = sorted(self.lags) or [0.0]
+        lag = {p: lags[min(len(lags) - 1, int(p / 100 * len(lags)))] * 1000 for p in (50, 95)}
+        memory_growth = [stat for stat in memory_diff if stat.size_diff > 0]
+
+        report = [
+            f"Profile started {started:%Y-%m-%d %H:%M:%S}, {duration:.1f} seconds, {self.samples} samples, {self.idle_samples} idle thread samples left out",
+            "",
+            f"Event loop lag: p50 {lag[50]:.1f}ms, p95 {lag[95]:.1f}ms, max {lags[-1] * 1000:.1f}ms",
+            f"Callbacks slower than {config['metrics']['slow_callback_duration']}s: {len(self.slow_callbacks)}",
+        ] + [f"  {message}" for message in self.slow_callbacks[:REPORT_LINES]] + [
+            "",
+            "Most time in the function itself (% of samples, in any thread):",
+        ] + [f"  {count / samples:6.1%}  {frame}" for frame, count in own_samples.most_common(REPORT_LINES)] + [
+            "",
+            "Most time including what the function called:",
+        ] + [f"  {count / samples:6.1%}  {frame}" for frame, count in total_samples.most_common(REPORT_LINES)] + [
+            "",
+            "Memory allocated and not freed during the profile:",
+        ] + [f"  {stat}" for stat in memory_growth[:REPORT_LINES]]
+        with open(name + ".txt", "w", encoding="utf-8") as f:
+            f.write("\n".join(report) + "\n")
+
+        summary = [
+            f"**Profile:** {duration:.1f} seconds, {self.samples} samples. Report in `{name}.txt`, stacks in `{name}.folded`.",
+            f"**Event loop lag:** p50 {lag[50]:.1f}ms, p95 {lag[95]:.1f}ms, max {lags[-1] * 1000:.1f}ms",
+            f"**Slow callbacks:** {len(self.slow_callbacks)}",
+        ] + [f"- {message[:200]}" for message in self.slow_callbacks[:SUMMARY_LINES]] + [
+            "**Most time spent in:**",
+        ] + [f"- {count / samples:.1%} `{frame}`" for frame, count in own_samples.most_common(SUMMARY_LINES)] + [
+            "**Memory growth:**",
+        ] + [f"- {stat.size_diff / 1024:+,.1f} KiB `{stat.traceback[0]}`" for stat in memory_growth[:SUMMARY_LINES]]
+        return "\n".join(summary)
+
+# Replaces asyncio.Handle._run while profiling, which runs each callback on the event loop
+def _timed_run(handle):
+    start = time.perf_counter()
+    untimed_run(handle)
+    duration = time.perf_counter() - start
+    if active is not None and duration >= config['metrics']['slow_callback_duration']:
+        # Most callbacks are steps of a task, which says more about what was running
+        task = getattr(handle._callback, "__self__", None)
+        active.slow_callbacks.append(f"{duration:.3f}s {task if isinstance(task, asyncio.Task) else handle}")
+
+def is_running():
+    return active is not None
+
+# Profiles for seconds, or until stop() is called. Returns a summary of the results.
+async def profile(seconds):
+    global active
+    if active is not None:
+        raise RuntimeError("A profile is already running")
+    active = Profile(min(seconds, MAX_SECONDS))
+    logger.info(f"Profiling for {active.seconds} seconds")
+    try:
+        return await active.run()
+    finally:
+        active = None
+
+# Returns False if there was no profile running
+def stop():
+    if active is None:
+        return False
+    active.stopped.set()
+    return True
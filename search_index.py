@@ -0,0 +1,136 @@
+import os
+import re
+import sqlite3
+from datetime import datetime
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS entries USING fts5(
+    speaker, content, log_path UNINDEXED, channel_id UNINDEXED, written_at UNINDEXED
+);
+CREATE TABLE IF NOT EXISTS log_files (
+    path TEXT PRIMARY KEY,
+    indexed_bytes INTEGER NOT NULL
+);
+"""
+
+INDEX_FILENAME = "search_index.db"
+MAX_RESULTS = 10
+
+# Campaigns share the index in the top adventure log directory
+indexes = {}
+
+def open_search_index(log_dir):
+    if log_dir not in indexes:
+        indexes[log_dir] = SearchIndex(os.path.join(log_dir, INDEX_FILENAME))
+    return indexes[log_dir]
+
+class SearchIndex:
+    """
+    A full text index of the adventure logs, in a SQLite database next to them.
+
+    The index remembers how much of each log file it has read, so only new entries
+    are indexed: as they're written, and on startup for anything written while the
+    bot wasn't running. Log files are only ever appended to, or renamed.
+
+    Each entry is stored with the time it was written, as given by AdventureLog.
+    Entries written while the bot wasn't running only have the log file's last
+    change to go by.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Worker processes share the index, see shards.py
+        self.db = sqlite3.connect(path, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    # Index whatever has been added to a log file since it was last indexed.
+    # written is (time, text) for each entry just appended to the file.
+    def update(self, log_path, channel_id, written=()):
+        with self.db:
+            # Read and advanced in one transaction, so two processes can't both index the same entries
+            self.db.execute("BEGIN IMMEDIATE")
+            row = self.db.execute("SELECT indexed_bytes FROM log_files WHERE path = ?", (log_path,)).fetchone()
+            indexed_bytes = row[0] if row else 0
+            size = os.path.getsize(log_path)
+            if size == indexed_bytes:
+                return
+            if size < indexed_bytes:
+                # Not the file we indexed, start again
+                self.db.execute("DELETE FROM entries WHERE log_path = ?", (log_path,))
+                indexed_bytes = 0
+            with open(log_path, "rb") as f:
+                f.seek(indexed_bytes)
+                data = f.read()
+            # Only index complete entries, the rest is picked up next time
+            end = data.rfind(b"\n\n")
+            if end == -1:
+                return
+            data = data[:end + 2]
+            # Only the entries at the end of the file have their own times
+            written_text = "".join(text for _, text in written).encode("utf-8")
+            if not written or not data.endswith(written_text):
+                written, written_text = (), b""
+            earlier = data[:len(data) - len(written_text)]
+            file_time = datetime.fromtimestamp(os.path.getmtime(log_path))
+            batches = ([(file_time, earlier.decode("utf-8"))] if earlier else []) + list(written)
+            self.db.executemany(
+                "INSERT INTO entries (speaker, content, log_path, channel_id, written_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (speaker, content, log_path, channel_id, written_at.isoformat(timespec="minutes"))
+                    for written_at, text in batches
+                    for speaker, content in _parse_entries(text)
+                ]
+            )
+            self.db.execute("INSERT OR REPLACE INTO log_files (path, indexed_bytes) VALUES (?, ?)", (log_path, indexed_bytes + len(data)))
+
+    def rename(self, old_path, new_path):
+        with self.db:
+            # Renaming replaces any file already at new_path
+            self.db.execute("DELETE FROM entries WHERE log_path = ?", (new_path,))
+            self.db.execute("DELETE FROM log_files WHERE path = ?", (new_path,))
+            self.db.execute("UPDATE entries SET log_path = ? WHERE log_path = ?", (new_path, old_path))
+            self.db.execute("UPDATE log_files SET path = ? WHERE path = ?", (new_path, old_path))
+
+    # Keywords must all match, "quoted phrases" must match exactly. Newest entries first.
+    def search(self, query, channel_id=None):
+        match = _match_expression(query)
+        if not match:
+            return []
+        sql = "SELECT log_path, channel_id, written_at, speaker, snippet(entries, 1, '**', '**', '…', 16) FROM entries WHERE entries MATCH ?"
+        params = [match]
+        if channel_id is not None:
+            sql += " AND channel_id = ?"
+            params.append(channel_id)
+        sql += " ORDER BY rowid DESC LIMIT ?"
+        params.append(MAX_RESULTS)
+        return [
+            {
+                "game_name": os.path.splitext(os.path.basename(log_path))[0],
+                "channel_id": channel_id,
+                "written_at": written_at,
+                "speaker": speaker,
+                "snippet": snippet,
+            }
+            for log_path, channel_id, written_at, speaker, snippet in self.db.execute(sql, params)
+        ]
+
+# Quote every term, so player text can't be mistaken for FTS5 query syntax
+def _match_expression(query):
+    terms = [phrase or word for phrase, word in re.findall(r'"([^"]+)"|(\S+)', query)]
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+# Splits log text into (speaker, content), matching the format written by AdventureLog
+def _parse_entries(text):
+    for chunk in text.split("\n\n"):
+        if not chunk.strip():
+            continue
+        if chunk.startswith("#### "):
+            speaker, _, content = chunk[5:].partition("\n")
+        elif chunk.startswith(">"):
+            speaker = "Storyteller"
+            content = "\n".join(line[2:] for line in chunk.split("\n"))
+        elif chunk.startswith("_") and chunk.endswith("_"):
+            speaker, content = "", chunk[1:-1]
+        else:
+            speaker, content = "", chunk
+        yield speaker, content
@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import sqlite3
+from config import config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaigns (
+    channel_id INTEGER PRIMARY KEY,
+    worker TEXT NOT NULL,
+    game_name TEXT,
+    heartbeat REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS commands (
+    id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    reply_channel_id INTEGER NOT NULL,
+    user_message TEXT NOT NULL,
+    mentions TEXT NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+# Seconds between a worker's checks for forwarded commands, and updates of its heartbeat
+POLL_INTERVAL = 0.5
+# A worker that hasn't updated its heartbeat for this long is assumed to have stopped
+WORKER_TIMEOUT = 30
+# Forwarded commands not run in this long are dropped, their admin has long given up
+COMMAND_TIMEOUT = 60
+
+# Discord sends each server's events to one shard, picked from its ID
+def shard_id(guild_id, shard_count):
+    return (guild_id >> 22) % shard_count
+
+# True when this process runs some of the shards, and other processes run the rest
+def is_worker():
+    return bool(config['discord']['shard_ids'])
+
+class ShardState:
+    """
+    What the worker processes need to know about each other, in a SQLite database
+    they share, files.shard_state.
+
+    Each worker runs the campaigns in the channels its shards can see, and records
+    them here. Admins' DMs always arrive at the worker running shard 0, so an admin
+    command for a campaign run by another worker is left here for that worker to
+    pick up. The reply is sent from there, straight to the admin's DM channel.
+    """
+    def __init__(self, path, worker):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.worker = worker
+        self.db = sqlite3.connect(path, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.channel_ids = []
+
+    # Records that this worker runs these campaigns, names by channel ID
+    def claim(self, game_names):
+        self.channel_ids = list(game_names)
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO campaigns (channel_id, worker, game_name, heartbeat) VALUES (?, ?, ?, ?)",
+                [(channel_id, self.worker, game_name, time.time()) for channel_id, game_name in game_names.items()]
+            )
+
+    # Keeps this worker's campaigns marked as running, with their current names
+    def heartbeat(self, game_names):
+        with self.db:
+            self.db.executemany(
+                "UPDATE campaigns SET game_name = ?, heartbeat = ? WHERE channel_id = ? AND worker = ?",
+                [(game_name, time.time(), channel_id, self.worker) for channel_id, game_name in game_names.items()]
+            )
+
+    # Every campaign some worker has claimed, as {channel_id: game_name}
+    def game_names(self):
+        return dict(self.db.execute("SELECT channel_id, game_name FROM campaigns ORDER BY channel_id"))
+
+    # The worker running a campaign, or None if no running worker has it
+    def owner(self, channel_id):
+        row = self.db.execute("SELECT worker, heartbeat FROM campaigns WHERE channel_id = ?", (channel_id,)).fetchone()
+        if row is None or time.time() - row[1] > WORKER_TIMEOUT:
+            return None
+        return row[0]
+
+    # mentions are (user ID, mention text) pairs, so they can be replaced with character names
+    def forward(self, channel_id, reply_channel_id, user_message, mentions):
+        with self.db:
+            self.db.execute(
+                "INSERT INTO commands (channel_id, reply_channel_id, user_message, mentions, created) VALUES (?, ?, ?, ?, ?)",
+                (channel_id, reply_channel_id, user_message, json.dumps(mentions), time.time())
+            )
+
+    # Forwarded commands for this worker's campaigns, oldest first, as
+    # (channel_id, reply_channel_id, user_message, mentions)
+    def take_commands(self):
+        if not self.channel_ids:
+            return []
+        placeholders = ",".join("?" * len(self.channel_ids))
+        with self.db:
+            # Taken and removed in one transaction, so a command is never run twice
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("DELETE FROM commands WHERE created < ?", (time.time() - COMMAND_TIMEOUT,))
+            rows = list(self.db.execute(
+                f"SELECT id, channel_id, reply_channel_id, user_message, mentions FROM commands "
+                f"WHERE channel_id IN ({placeholders}) ORDER BY id",
+                self.channel_ids
+            ))
+            self.db.executemany("DELETE FROM commands WHERE id = ?", [(row[0],) for row in rows])
+        return [
+            (channel_id, reply_channel_id, user_message, [tuple(mention) for mention in json.loads(mentions)])
+            for _, channel_id, reply_channel_id, user_message, mentions in rows
+        ]
+
+# Set up by storyteller.py for worker processes
+shard_state = None
+
+def open_shard_state():
+    global shard_state
+    if shard_state is None:
+        worker = "shards " + ",".join(str(shard) for shard in config['discord']['shard_ids'])
+        shard_state = ShardState(config['files']['shard_state'], worker)
+    return shard_state
@@ -0,0 +1,244 @@
+import json
+import sqlite3
+from datetime import datetime
+from context import get_empty_context
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaigns (
+    channel_id INTEGER PRIMARY KEY,
+    game_name TEXT NOT NULL,
+    status TEXT,
+    last_status_update TEXT,
+    token_usage INTEGER,
+    previous_users TEXT,
+    memory TEXT
+);
+CREATE TABLE IF NOT EXISTS characters (
+    channel_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (channel_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS characters_name ON characters (name);
+CREATE TABLE IF NOT EXISTS log_entries (
+    id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    game_name TEXT NOT NULL,
+    position INTEGER,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS log_entries_position ON log_entries (channel_id, position);
+CREATE INDEX IF NOT EXISTS log_entries_game ON log_entries (channel_id, game_name, created_at);
+CREATE TABLE IF NOT EXISTS status_history (
+    id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS status_history_channel ON status_history (channel_id, updated_at);
+"""
+
+# Game context fields stored as JSON in the campaigns table
+JSON_FIELDS = ("previous_users", "memory")
+CAMPAIGN_FIELDS = ("game_name", "status", "last_status_update", "token_usage") + JSON_FIELDS
+
+# files.fsync mapped to SQLite's synchronous setting. In WAL mode, NORMAL only
+# syncs when the WAL is checkpointed, which is like syncing on each snapshot.
+SYNCHRONOUS = {"always": "FULL", "snapshot": "NORMAL", "never": "OFF"}
+
+# Campaigns share a connection to each database
+connections = {}
+
+def _connect(files):
+    path = files['database']
+    if path not in connections:
+        db = sqlite3.connect(path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(f"PRAGMA synchronous={SYNCHRONOUS[files['fsync']]}")
+        db.executescript(SCHEMA)
+        connections[path] = db
+    return connections[path]
+
+class SqliteStore:
+    """
+    Saves and loads one campaign's game context in the SQLite database files.database.
+    All campaigns share the database, keyed by channel ID.
+
+    Each change is written as soon as it's made, usually a single row insert or
+    update. Log entries removed from the log by summarization keep their row, with
+    no position, so the full history of each game can still be queried.
+    """
+    def __init__(self, files, channel_id):
+        self.files = files
+        self.channel_id = channel_id
+        self.db = _connect(files)
+        # Row ID of each entry in the log, in log order
+        self.log_ids = []
+        self.game_name = None
+        self.persistence_stats = {"save_requests": 0, "writes": 0}
+
+    def load_game_context(self):
+        row = self.db.execute(
+            f"SELECT {', '.join(CAMPAIGN_FIELDS)} FROM campaigns WHERE channel_id = ?", (self.channel_id,)
+        ).fetchone()
+        if row is None:
+            context = get_empty_context()
+            self.save_game_context(context)
+            return context
+
+        context = get_empty_context()
+        for field, value in zip(CAMPAIGN_FIELDS, row):
+            if value is not None:
+                context[field] = _from_column(field, value)
+        self.game_name = context["game_name"]
+
+        context["characters"] = {
+            user_id: json.loads(data)
+            for user_id, data in self.db.execute("SELECT user_id, data FROM characters WHERE channel_id = ?", (self.channel_id,))
+        }
+
+        self.log_ids = []
+        context["log"] = []
+        for row_id, role, content, tokens in self.db.execute(
+            "SELECT id, role, content, tokens FROM log_entries WHERE channel_id = ? AND position IS NOT NULL ORDER BY position",
+            (self.channel_id,)
+        ):
+            self.log_ids.append(row_id)
+            entry = {"role": role, "content": content}
+            if tokens is not None:
+                entry["tokens"] = tokens
+            context["log"].append(entry)
+        return context
+
+    # The connection belongs to the event loop's thread. Loading from SQLite only
+    # reads the current log, so it's quick anyway.
+    async def load_game_context_in_background(self):
+        return self.load_game_context()
+
+    def save_game_context(self, game_context):
+        self.persistence_stats["save_requests"] += 1
+        with self.db:
+            self.db.execute(
+                f"INSERT OR REPLACE INTO campaigns (channel_id, {', '.join(CAMPAIGN_FIELDS)}) VALUES (?{', ?' * len(CAMPAIGN_FIELDS)})",
+                (self.channel_id, *(_to_column(field, game_context[field]) for field in CAMPAIGN_FIELDS))
+            )
+            self.game_name = game_context["game_name"]
+
+            self.db.execute("DELETE FROM characters WHERE channel_id = ?", (self.channel_id,))
+            for user_id, character in game_context["characters"].items():
+                self._set_character(user_id, character)
+
+            # Keep the rows of entries that are still in the log, and unlink the rest
+            current_rows = {}
+            for row_id, role, content in self.db.execute(
+                "SELECT id, role, content FROM log_entries WHERE channel_id = ? AND position IS NOT NULL ORDER BY position",
+                (self.channel_id,)
+            ):
+                current_rows.setdefault((role, content), []).append(row_id)
+            self.db.execute("UPDATE log_entries SET position = NULL WHERE channel_id = ? AND position IS NOT NULL", (self.channel_id,))
+            self.log_ids = []
+            for position, entry in enumerate(game_context["log"]):
+                reusable_rows = current_rows.get((entry["role"], entry["content"]))
+                if reusable_rows:
+                    row_id = reusable_rows.pop(0)
+                    self.db.execute("UPDATE log_entries SET position = ? WHERE id = ?", (position, row_id))
+                    self.log_ids.append(row_id)
+                else:
+                    self._insert_entry(position, entry)
+        self.persistence_stats["writes"] += 1
+
+    def journal_game_context(self, game_context, records):
+        if not records:
+            return
+        self.persistence_stats["save_requests"] += 1
+        with self.db:
+            for record in records:
+                self._apply_record(record)
+        self.persistence_stats["writes"] += 1
+
+    def _apply_record(self, record):
+        op = record["op"]
+        if op == "log_append":
+            last_position = self.db.execute(
+                "SELECT MAX(position) FROM log_entries WHERE channel_id = ?", (self.channel_id,)
+            ).fetchone()[0]
+            self._insert_entry(0 if last_position is None else last_position + 1, record["entry"])
+        elif op == "log_update":
+            entry = record["entry"]
+            self.db.execute(
+                "UPDATE log_entries SET role = ?, content = ?, tokens = ? WHERE id = ?",
+                (entry["role"], entry["content"], entry.get("tokens"), self.log_ids[record["index"]])
+            )
+        elif op == "log_pop":
+            self.db.execute("DELETE FROM log_entries WHERE id = ?", (self.log_ids.pop(),))
+        elif op == "log_prune_system" and "positions" in record:
+            removed_ids = [self.log_ids[position] for position in record["positions"]]
+            self.db.executemany("DELETE FROM log_entries WHERE id = ?", [(row_id,) for row_id in removed_ids])
+            for position in reversed(record["positions"]):
+                del self.log_ids[position]
+        elif op == "log_prune_system":
+            self.db.execute(
+                "DELETE FROM log_entries WHERE channel_id = ? AND position IS NOT NULL AND role = 'system' AND id != ?",
+                (self.channel_id, self.log_ids[0])
+            )
+            self.log_ids = [row_id for row_id, in self.db.execute(
+                "SELECT id FROM log_entries WHERE channel_id = ? AND position IS NOT NULL ORDER BY position", (self.channel_id,)
+            )]
+        elif op == "character_set":
+            self._set_character(record["user_id"], record["character"])
+        elif op == "character_delete":
+            self.db.execute("DELETE FROM characters WHERE channel_id = ? AND user_id = ?", (self.channel_id, record["user_id"]))
+        elif op == "set" and record["key"] in CAMPAIGN_FIELDS:
+            key, value = record["key"], record["value"]
+            self.db.execute(f"UPDATE campaigns SET {key} = ? WHERE channel_id = ?", (_to_column(key, value), self.channel_id))
+            if key == "status":
+                self.db.execute(
+                    "INSERT INTO status_history (channel_id, status, updated_at) VALUES (?, ?, ?)",
+                    (self.channel_id, value, datetime.now().isoformat())
+                )
+            elif key == "game_name":
+                self.db.execute(
+                    "UPDATE log_entries SET game_name = ? WHERE channel_id = ? AND game_name = ?",
+                    (value, self.channel_id, self.game_name)
+                )
+                self.game_name = value
+        else:
+            raise ValueError(f"Unknown journal record: {op} {record.get('key', '')}")
+
+    def _insert_entry(self, position, entry):
+        cursor = self.db.execute(
+            "INSERT INTO log_entries (channel_id, game_name, position, role, content, tokens, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (self.channel_id, self.game_name, position, entry["role"], entry["content"], entry.get("tokens"), datetime.now().isoformat())
+        )
+        self.log_ids.append(cursor.lastrowid)
+
+    def _set_character(self, user_id, character):
+        self.db.execute(
+            "INSERT OR REPLACE INTO characters (channel_id, user_id, name, data) VALUES (?, ?, ?, ?)",
+            (self.channel_id, user_id, character["name"], json.dumps(character))
+        )
+
+    # Changes are written straight away, there's nothing to do in the background
+    def start_persistence(self):
+        pass
+
+    async def flush_game_context(self, game_context=None):
+        pass
+
+def _to_column(field, value):
+    if field in JSON_FIELDS:
+        return json.dumps(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def _from_column(field, value):
+    if field in JSON_FIELDS:
+        return json.loads(value)
+    if field == "last_status_update":
+        return datetime.fromisoformat(value)
+    return value
@@ -1,36 +1,121 @@
 import asyncio
 import signal
+import sqlite3
+from types import SimpleNamespace
 from logger import logger
 from datetime import datetime, timedelta
 from config import config
 import game_logic as game
-from discord_client import client, discord_safe_send, set_activity_presence
+from action_queue import ActionQueue, QueuedAction, position_react
+from discord_client import client, discord_safe_send, set_activity_presence, StreamingMessage
+from outbox import get_outbox, MESSAGE
 import admin_commands
+import metrics
+import shards
 
 # Update status event
 STATUS_REFRESH_INTERVAL = 30
 status_update_task = None
+load_task = None
+forwarded_commands_task = None
+# Set once this process knows which campaigns it runs: straight away, unless it's
+# one of several worker processes, see shards.py
+campaigns_claimed = asyncio.Event()
+# Keep references to background summaries and forwarded admin commands, so they aren't garbage collected
+background_summary_tasks = set()
+forwarded_command_tasks = set()
+
+# The bot only has one presence, so it shows the most recently active campaign.
+# None if this worker process has no campaigns.
+def _latest_game_context():
+    return max((campaign.game_context for campaign in game.campaigns.values()), key=lambda context: context["last_status_update"], default=None)
+
 async def update_status_task():
+    await game.load_campaigns()
     idle_timeout = config['discord']['idle_timeout']
     if idle_timeout:
         idle_timeout = timedelta(minutes=idle_timeout)
         while True:
             await asyncio.sleep(STATUS_REFRESH_INTERVAL)
-            is_idle = datetime.now() - game.game_context["last_status_update"] > idle_timeout
-            await set_activity_presence(game.game_context["status"], is_idle)
+            game_context = _latest_game_context()
+            if game_context is None:
+                continue
+            is_idle = datetime.now() - game_context["last_status_update"] > idle_timeout
+            await set_activity_presence(game_context["status"], is_idle)
     else:
         while True:
             await asyncio.sleep(STATUS_REFRESH_INTERVAL)
-            await set_activity_presence(game.game_context["status"])
+            game_context = _latest_game_context()
+            if game_context is not None:
+                await set_activity_presence(game_context["status"])
+
+async def load_campaigns():
+    try:
+        await game.load_campaigns()
+    except Exception as e:
+        logger.fatal(f"Failed to load the game contexts. Error: {e}. Exiting.")
+        await client.close()
+        return
+    game.start_persistence()
+
+# For worker processes: runs the campaigns in channel_ids, the ones its shards can
+# see, and the admin commands other workers forward for them
+async def start_worker(channel_ids):
+    global load_task, forwarded_commands_task
+    game.keep_campaigns(channel_ids)
+    logger.info(f"Running {len(game.campaigns)} of {len(config['discord']['channel_ids'])} campaigns in this worker")
+    shard_state = shards.open_shard_state()
+    campaigns_claimed.set()
+    load_task = client.loop.create_task(load_campaigns())
+    await load_task
+    if client.is_closed():
+        return
+    shard_state.claim(_game_names())
+    forwarded_commands_task = client.loop.create_task(run_forwarded_commands())
+
+def _game_names():
+    return {channel_id: campaign.game_context["game_name"] for channel_id, campaign in game.campaigns.items()}
+
+async def run_forwarded_commands():
+    shard_state = shards.open_shard_state()
+    while True:
+        await asyncio.sleep(shards.POLL_INTERVAL)
+        try:
+            shard_state.heartbeat(_game_names())
+            commands = shard_state.take_commands()
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to check for forwarded admin commands. Error: {e}")
+            continue
+        for channel_id, reply_channel_id, user_message, mentions in commands:
+            # Replies go straight to the admin's DM channel, which this worker can send to without seeing it
+            channel = client.get_partial_messageable(reply_channel_id)
+            mentions = [SimpleNamespace(id=user_id, mention=mention) for user_id, mention in mentions]
+            task = client.loop.create_task(run_admin_command(game.get_campaign(channel_id), channel, user_message, mentions, channel.send))
+            forwarded_command_tasks.add(task)
+            task.add_done_callback(forwarded_command_tasks.discard)
+
+@client.event
+async def setup_hook():
+    # Load the game contexts while connecting to Discord. A worker process only
+    # knows which campaigns are its own once it's connected.
+    global load_task
+    if not shards.is_worker():
+        campaigns_claimed.set()
+        load_task = client.loop.create_task(load_campaigns())
 
 @client.event
 async def on_ready():
     logger.info(f'Bot has connected as {client.user}')
 
+    if shards.is_worker() and not campaigns_claimed.is_set():
+        # A channel is only seen by the worker whose shards have its server
+        await start_worker([channel_id for channel_id in game.campaigns if client.get_channel(channel_id) is not None])
+
     # Ensure task is started only once
     global status_update_task
     if status_update_task is None:
         status_update_task = client.loop.create_task(update_status_task())
+    await metrics.start_metrics_server()
 
 @client.event
 async def on_message(message):
@@ -42,46 +127,70 @@ async def on_message(message):
         return
 
     user_id = message.author.id
+    # Messages that arrive while the game contexts are loading wait for them
+    await campaigns_claimed.wait()
+    await game.load_campaigns()
 
     if message.guild is None and user_id in config['discord']['admin_ids']:
         await handle_admin_command(user_message, message)
-    elif message.channel.id == config['discord']['channel_id']:
-        await handle_public_message(user_id, user_message, message)
+    else:
+        campaign = game.get_campaign(message.channel.id)
+        if campaign is not None:
+            await handle_public_message(campaign, user_id, user_message, message)
 
 async def handle_admin_command(user_message, message):
-    for command, handler, reject_if_game_locked in admin_commands.command_handlers:
-        if user_message.lower().startswith(command):
-            user_message, _ = user_message_extract(user_message, message)
-            params = user_message[len(command):].lstrip()
-
-            # Deal with blocking actions
-            if reject_if_game_locked and game.is_game_locked():
-                await message.reply("I'm currently busy processing an action. Please try again in a moment.")
-            else:
-                await handler(message.channel, params)
+    found = admin_commands.find_command(user_message)
+    if found is None:
+        await message.channel.send(f"{user_message}: Command not recognized.")
+        return
+
+    # Admin commands apply to whichever campaign the admin has selected
+    campaign = admin_commands.get_selected_campaign(message.channel.id)
+    if campaign is None and found[1] not in admin_commands.local_commands:
+        # The campaign is run by another worker process, which sends the reply
+        channel_id = admin_commands.get_selected_channel_id(message.channel.id)
+        shard_state = shards.open_shard_state()
+        if shard_state.owner(channel_id) is None:
+            await message.channel.send(f"No worker is running the campaign in channel {channel_id}. Use `!campaign` to pick another.")
             return
+        shard_state.forward(channel_id, message.channel.id, user_message, [(user.id, user.mention) for user in message.mentions])
+        return
+    await run_admin_command(campaign, message.channel, user_message, message.mentions, message.reply)
 
-    await message.channel.send(f"{user_message}: Command not recognized.")
+# reply is for answering the message the command came in, for forwarded commands it's
+# a plain message instead
+async def run_admin_command(campaign, channel, user_message, mentions, reply):
+    command, handler, reject_if_game_locked = admin_commands.find_command(user_message)
+    if campaign is not None:
+        user_message, _ = user_message_extract(campaign, user_message, mentions)
+    params = user_message[len(command):].lstrip()
 
-def user_message_extract(user_message, message):
+    # Deal with blocking actions
+    if reject_if_game_locked and game.is_game_locked(campaign):
+        await reply("I'm currently busy processing an action. Please try again in a moment.")
+    else:
+        await handler(campaign, channel, params)
+
+def user_message_extract(campaign, user_message, mentions):
     fourth_wall = False
-    for user in message.mentions:
-        if user.id in game.game_context["characters"]:
-            char_name = game.game_context["characters"][user.id]["name"]
+    characters = campaign.game_context["characters"]
+    for user in mentions:
+        if user.id in characters:
+            char_name = characters[user.id]["name"]
             user_message = user_message.replace(user.mention, char_name)
         else:
             fourth_wall = True
 
     return user_message, fourth_wall
 
-async def handle_public_message(user_id, user_message, message):
+async def handle_public_message(campaign, user_id, user_message, message):
     lower_message = user_message.lstrip("_*").lower()
 
     # Ignore whispers up front, no need to process them
     if lower_message.startswith(("!w", "(w)", "(whisper")):
         return
 
-    user_message, fourth_wall = user_message_extract(user_message, message)
+    user_message, fourth_wall = user_message_extract(campaign, user_message, message.mentions)
 
     # Commands that can be used without a character
     if lower_message.startswith("!newcharacter"):
@@ -91,11 +200,11 @@ async def handle_public_message(user_id, user_message, message):
         except ValueError:
             await message.reply("Please use the format: `!newcharacter name, race, class, pronouns, appearance`.")
         else:
-            response = await game.create_character(user_id, name, race, pronouns, char_class, appearance)
-            await message.channel.send(response)
+            response = await game.create_character(campaign, user_id, name, race, pronouns, char_class, appearance)
+            await discord_safe_send(response, message.channel, MESSAGE)
     
     # Check if the player has a character
-    elif user_id not in game.game_context["characters"]:
+    elif user_id not in campaign.game_context["characters"]:
         await message.reply("Please create a character first using `!newcharacter name, race, class, pronouns`.")
 
     # Check if the player is breaking the fourth wall command
@@ -106,22 +215,26 @@ async def handle_public_message(user_id, user_message, message):
     elif lower_message.startswith(("!say","(say)", ">")):
         # Remove the command prefix by length so the player can omit the space after the command.
         quote = user_message[{'!': 4, '(': 5, '>': 1}[user_message[0]]:].lstrip()
-        await game.player_say(user_id, quote)
+        await game.player_say(campaign, user_id, quote)
         if config['game']['say_react']:
-            await message.add_reaction(config['game']['say_react'])
+            get_outbox(message.channel).add_reaction(message, config['game']['say_react'])
     elif lower_message.startswith("!leavetheparty"):
         # Remove the command and trim to see if there's the optional parameter
         leave_message = user_message[15:].strip()
-        leave_message = await game.character_leaves(user_id, leave_message)
+        leave_message = await game.character_leaves(campaign, user_id, leave_message)
         await message.reply(leave_message)
 
     # Check if the player is trying to use some other command
     elif lower_message.startswith("!"):
         await message.reply(f"{user_message}: Command not recognized.")
 
-    # Check if the player has taken a turn recently
-    elif user_id in game.game_context["previous_users"]:
-        remaining_turns = game.players_until_turn(user_id)
+    # Check if the player already has an action waiting
+    elif campaign.action_queue.has_action(user_id):
+        await message.reply("Your last action is still waiting for the storyteller. Please wait for it before acting again.")
+
+    # Check if the player has taken a turn recently, counting turns still waiting in the queue
+    elif game.players_until_turn(campaign, user_id, campaign.action_queue.turn_user_ids()) > 0:
+        remaining_turns = game.players_until_turn(campaign, user_id, campaign.action_queue.turn_user_ids())
         player_word = "player" if remaining_turns == 1 else "players"
         await message.reply(
             f"You've already taken a turn recently. Please wait for {remaining_turns} more {player_word} to take a turn before acting again."
@@ -129,48 +242,153 @@ async def handle_public_message(user_id, user_message, message):
 
     # If no command was issued, the player is taking an action
     else:
-        if not game.is_game_locked():
-            await handle_player_action(user_id, user_message, message)
-        else:
-            await message.reply("I'm currently busy processing an action. Please try again in a moment.")
+        await queue_player_action(campaign, QueuedAction(user_id, user_message, message))
+
+async def queue_player_action(campaign, action):
+    position = await campaign.action_queue.submit(action)
+    if position is None:
+        await action.message.reply("The storyteller has too many actions waiting. Please try again in a moment.")
+    elif position > 0:
+        # Let the player know their place in the queue
+        action.react = position_react(position)
+        get_outbox(action.message.channel).add_reaction(action.message, action.react)
 
-async def add_dice_reactions(message, dice_values):
+# actions is a list, with game.batch_window several actions can be answered together
+async def run_queued_actions(campaign, actions):
+    ready_actions = []
+    for action in actions:
+        metrics.observe("queue_wait", action.waited())
+        if action.react:
+            get_outbox(action.message.channel).remove_reaction(action.message, action.react, client.user)
+        # Things may have changed while the action was waiting
+        if action.user_id not in campaign.game_context["characters"]:
+            campaign.action_queue.finish([action])
+            continue
+        if game.players_until_turn(campaign, action.user_id, [ready.user_id for ready in ready_actions]) > 0:
+            campaign.action_queue.finish([action])
+            await action.message.reply("You've already taken a turn recently. Your action was skipped.")
+            continue
+        ready_actions.append(action)
+    if ready_actions:
+        await handle_player_actions(campaign, ready_actions)
+
+async def expire_queued_action(action):
+    if action.react:
+        get_outbox(action.message.channel).remove_reaction(action.message, action.react, client.user)
+    await action.message.reply("Sorry, your action waited too long for the storyteller. Please try again.")
+
+CHARACTER_LEFT = "Your character left the game before the storyteller got to your action. It was skipped."
+
+# Reactions are sent after the story, so they're not waited for
+def add_dice_reactions(message, dice_values):
+    outbox = get_outbox(message.channel)
     for i, value in enumerate(dice_values):
-        await message.add_reaction(config['game']['dice_reacts'][i][value - 1])
+        outbox.add_reaction(message, config['game']['dice_reacts'][i][value - 1])
 
-async def handle_player_action(user_id, user_message, message):
-    channel = message.channel
-    async with channel.typing():
-        response_prefix = ""
-        dice_values = game.roll_dice()
-        # Start the AI processing the player's action, we do this so we can send dice reactions while the AI is working
-        respond_to_player_task = client.loop.create_task(game.respond_to_player(user_id, user_message, dice_values))
-        # Dice as reactions
-        if dice_values and config['game']['dice_reacts']:
-            await add_dice_reactions(message, dice_values)
-        # Dice in response text
-        elif dice_values:
-            dice_result = " ".join(config['game']['dice_strings'][value - 1] for value in dice_values)
-            response_prefix = f"You rolled: {dice_result}\n\n"
-
-        response = await respond_to_player_task
-        await discord_safe_send(response_prefix + response, channel)
-
-    if game.game_context["token_usage"] > config['game']['max_log_tokens']:
+async def handle_player_actions(campaign, actions):
+    channel = actions[0].message.channel
+    # Summarize before sending a request that would go over the token budget.
+    # Each summary only takes one chapter from the log, so it may take a few.
+    while game.is_over_token_budget(campaign, "\n".join(action.user_message for action in actions)):
+        summarised_context = campaign.game_context
         async with channel.typing():
-            response = await game.summarize_adventure()
+            response = await game.summarize_adventure(campaign)
         if response != False:
             await discord_safe_send(response, channel)
+        # A new game was started or restored while summarizing, check the budget again
+        # for the actions whose players still have characters
+        elif campaign.game_context is not summarised_context:
+            for action in actions:
+                if action.user_id not in campaign.game_context["characters"]:
+                    await action.message.reply(CHARACTER_LEFT)
+            actions = [action for action in actions if action.user_id in campaign.game_context["characters"]]
+            if not actions:
+                return
+        # The summary failed, or there was nothing to summarize. Only these actions
+        # are dropped, the next one will try again.
+        else:
+            logger.error("Summarization due to exceeding max_log_tokens failed, the actions were not answered.")
+            await channel.send("The story is too long to continue and couldn't be summarized. Please try again later.")
+            return
+
+    async with channel.typing():
+        response_prefix = ""
+        all_dice_values = [game.roll_dice() for _ in actions]
+        streaming_message = StreamingMessage(channel) if config['discord']['stream_replies'] else None
+        on_text = streaming_message.update if streaming_message else None
+        # Start the AI processing the players' actions, we do this so we can send dice reactions while the AI is working
+        player_actions = [(action.user_id, action.user_message, dice_values) for action, dice_values in zip(actions, all_dice_values)]
+        respond_to_players_task = client.loop.create_task(game.respond_to_players(campaign, player_actions, on_text))
+        for action, dice_values in zip(actions, all_dice_values):
+            # Dice as reactions
+            if dice_values and config['game']['dice_reacts']:
+                add_dice_reactions(action.message, dice_values)
+            # Dice in response text
+            elif dice_values:
+                dice_result = " ".join(config['game']['dice_strings'][value - 1] for value in dice_values)
+                if len(actions) == 1:
+                    response_prefix = f"You rolled: {dice_result}\n\n"
+                # Characters can leave before the reply, respond_to_players skips their actions
+                elif action.user_id in campaign.game_context["characters"]:
+                    character_name = campaign.game_context["characters"][action.user_id]["name"]
+                    response_prefix += f"{character_name} rolled: {dice_result}\n"
+        if response_prefix and len(actions) > 1:
+            response_prefix += "\n"
+        if streaming_message:
+            streaming_message.prefix = response_prefix
+
+        response, skipped = await respond_to_players_task
+        campaign.action_queue.finish(actions)
+        for action in actions:
+            if action.user_id in skipped:
+                await action.message.reply(CHARACTER_LEFT)
+        if response is None:
+            return
+        if streaming_message:
+            await streaming_message.finish(response)
         else:
-            logger.fatal("Summarization due to exceeding max_log_tokens failed. This is fatal, exiting.")
-            client.close()
+            await discord_safe_send(response_prefix + response, channel)
+        for action in actions:
+            if action.user_id not in skipped:
+                metrics.observe("turn", action.waited())
+    game.prefetch_scene_image(campaign)
+
+    # Start summarizing in the background before the hard limit is reached
+    if game.is_over_summary_threshold(campaign) and not game.is_summary_running(campaign):
+        task = client.loop.create_task(background_summary(campaign, channel))
+        background_summary_tasks.add(task)
+        task.add_done_callback(background_summary_tasks.discard)
+
+async def background_summary(campaign, channel):
+    response = await game.summarize_adventure(campaign)
+    if response != False:
+        await discord_safe_send(response, channel)
+    else:
+        logger.error("Background summarization failed, will try again after the next action.")
+
+async def shutdown():
+    await game.flush_game_contexts()
+    await client.close()
 
 def handle_shutdown():
-    logger.info("Shutdown signal received. Closing Discord client.")
-    client.loop.create_task(client.close())
+    logger.info("Shutdown signal received. Saving and closing Discord client.")
+    client.loop.create_task(shutdown())
+
+def create_action_queues():
+    for campaign in game.campaigns.values():
+        campaign.action_queue = ActionQueue(
+            lambda actions, campaign=campaign: run_queued_actions(campaign, actions),
+            expire_queued_action
+        )
+
+def main():
+    create_action_queues()
+
+    # Register signal handlers for graceful shutdown
+    signal.signal(signal.SIGINT, lambda s, f: handle_shutdown())
+    signal.signal(signal.SIGTERM, lambda s, f: handle_shutdown())
 
-# Register signal handlers for graceful shutdown
-signal.signal(signal.SIGINT, lambda s, f: handle_shutdown())
-signal.signal(signal.SIGTERM, lambda s, f: handle_shutdown())
+    client.run(config['discord']['bot_token'])
 
-client.run(config['discord']['bot_token'])
+if __name__ == "__main__":
+    main()
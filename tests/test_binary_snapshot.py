@@ -0,0 +1,66 @@
+import os
+import sys
+import unittest
+from datetime import datetime
+
+# config.py reads the config file named in sys.argv[1]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.argv = [sys.argv[0], os.path.join(ROOT, "config_example.yaml")]
+
+import binary_snapshot
+from context import _json_default, _json_object_hook
+
+def _context():
+    return {
+        "game_name": "The Ashford Mill",
+        "characters": {
+            123456789012345678: {"name": "Mirelle", "race": "elf", "pronouns": "she/her", "class": "rogue", "appearance": "tall", "level": 3},
+            42: {"name": "Bram", "race": "dwarf", "pronouns": "he/him", "class": "cleric", "appearance": "bearded"},
+        },
+        "log": [
+            {"role": "system", "content": "You are the storyteller.", "tokens": 5},
+            {"role": "user", "content": "Mirelle: I open the door 🚪", "tokens": 9},
+            {"role": "assistant", "content": "The door creaks open. Ünderneath, a cellar.", "tokens": 11, "position": 7},
+            {"role": "user", "content": ""},
+        ],
+        "previous_users": [42],
+        "memory": {"arc": "", "chapters": [{"content": "Chapter one.", "tokens": 3}]},
+        "token_usage": -1,
+        "status": "Mirelle made a decision...",
+        "last_status_update": datetime(2026, 1, 2, 3, 4, 5),
+    }
+
+class BinarySnapshotTest(unittest.TestCase):
+    def test_round_trip(self):
+        context = _context()
+        data = binary_snapshot.dumps(context, 17, _json_default)
+        self.assertTrue(binary_snapshot.is_snapshot(data))
+        loaded, journal_seq = binary_snapshot.loads(data, _json_object_hook)
+        self.assertEqual(journal_seq, 17)
+        self.assertEqual(loaded, context)
+
+    # JSON would turn the character keys into strings, they must come back as ints
+    def test_character_keys_stay_ints(self):
+        loaded, _ = binary_snapshot.loads(binary_snapshot.dumps(_context(), 0, _json_default), _json_object_hook)
+        self.assertEqual(sorted(loaded["characters"]), [42, 123456789012345678])
+        self.assertEqual(loaded["characters"][123456789012345678]["level"], 3)
+
+    def test_entry_extras_and_missing_tokens(self):
+        loaded, _ = binary_snapshot.loads(binary_snapshot.dumps(_context(), 0, _json_default), _json_object_hook)
+        self.assertEqual(loaded["log"][2]["position"], 7)
+        self.assertNotIn("position", loaded["log"][1])
+        self.assertNotIn("tokens", loaded["log"][3])
+
+    def test_datetimes(self):
+        loaded, _ = binary_snapshot.loads(binary_snapshot.dumps(_context(), 0, _json_default), _json_object_hook)
+        self.assertEqual(loaded["last_status_update"], datetime(2026, 1, 2, 3, 4, 5))
+
+    def test_corrupt_snapshot_is_rejected(self):
+        data = bytearray(binary_snapshot.dumps(_context(), 0, _json_default))
+        data[len(data) // 2] ^= 0xFF
+        with self.assertRaises(ValueError):
+            binary_snapshot.loads(bytes(data), _json_object_hook)
+
+if __name__ == "__main__":
+    unittest.main()
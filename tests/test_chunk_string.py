@@ -0,0 +1,48 @@
+import os
+import sys
+import random
+import unittest
+
+# config.py reads the config file named in sys.argv[1]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.argv = [sys.argv[0], os.path.join(ROOT, "config_example.yaml")]
+
+from config import config
+from discord_client import chunk_string
+
+class ChunkStringTest(unittest.TestCase):
+    def setUp(self):
+        self.limit = config['discord']['message_length']
+
+    def tearDown(self):
+        config['discord']['message_length'] = self.limit
+
+    def assertChunks(self, text):
+        chunks = chunk_string(text)
+        self.assertTrue(chunks)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), config['discord']['message_length'])
+        return chunks
+
+    # The only line end in reach is the one after the opening fence
+    def test_long_first_line_of_code_block(self):
+        config['discord']['message_length'] = 2000
+        self.assertChunks("```\n" + "x" * 2100 + "\n```")
+        self.assertChunks("Intro\n\n```\n" + "word " * 450 + "\n```")
+
+    def test_code_block_split_is_reopened(self):
+        config['discord']['message_length'] = 100
+        chunks = self.assertChunks("```python\n" + "print('hello')\n" * 20 + "```")
+        self.assertTrue(chunks[0].endswith("```"))
+        self.assertTrue(chunks[1].startswith("```python\n"))
+
+    def test_random_markdown(self):
+        config['discord']['message_length'] = 100
+        rng = random.Random(1)
+        pieces = ["```", "```py", "`", "**", "_", "\n", "\n\n", " ", "word", "x" * 30]
+        for _ in range(2000):
+            self.assertChunks("".join(rng.choice(pieces) for _ in range(rng.randint(1, 80))))
+
+if __name__ == "__main__":
+    unittest.main()
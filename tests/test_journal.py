@@ -0,0 +1,88 @@
+import os
+import sys
+import tempfile
+import unittest
+
+# config.py reads the config file named in sys.argv[1]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.argv = [sys.argv[0], os.path.join(ROOT, "config_example.yaml")]
+
+from context import GameStore, get_empty_context
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.files = {
+            'game': os.path.join(self.temp_dir.name, "game.yaml"),
+            'snapshot_format': "binary",
+            'journal_compact_every': 100,
+            'save_delay': 1.0,
+            'fsync': "never",
+        }
+        self.store = GameStore(self.files)
+        self.context = get_empty_context()
+        self.store.save_game_context(self.context)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _append(self, entry):
+        self.context["log"].append(entry)
+        self.store.journal_game_context(self.context, [{"op": "log_append", "entry": entry}])
+
+    def test_replay(self):
+        self._append({"role": "user", "content": "Mirelle: I open the door"})
+        self.store.journal_game_context(self.context, [{"op": "character_set", "user_id": 42, "character": {"name": "Bram"}}])
+        context = GameStore(self.files).read_game_context()
+        self.assertEqual(context["log"][-1]["content"], "Mirelle: I open the door")
+        self.assertEqual(context["characters"], {42: {"name": "Bram"}})
+
+    # A crash part way through a write leaves half a line at the end of the journal
+    def test_torn_last_line(self):
+        self._append({"role": "user", "content": "Mirelle: I open the door"})
+        with open(self.store.journal_path, 'a', encoding="utf-8") as f:
+            f.write('{"seq": 2, "op": "log_append", "entry": {"role": "assis')
+        context = GameStore(self.files).read_game_context()
+        self.assertEqual([entry["content"] for entry in context["log"][1:]], ["Mirelle: I open the door"])
+
+    # A crash after writing the snapshot but before clearing the journal leaves
+    # records the snapshot already includes
+    def test_records_in_snapshot_are_skipped(self):
+        self._append({"role": "user", "content": "Mirelle: I open the door"})
+        with open(self.store.journal_path, 'r', encoding="utf-8") as f:
+            old_journal = f.read()
+        self.store.save_game_context(self.context)
+        with open(self.store.journal_path, 'w', encoding="utf-8") as f:
+            f.write(old_journal)
+        context = GameStore(self.files).read_game_context()
+        self.assertEqual(len(context["log"]), 2)
+
+    def test_prune_system_by_position(self):
+        self._append({"role": "system", "content": "Dice roll"})
+        self._append({"role": "user", "content": "Mirelle: I open the door"})
+        self._append({"role": "system", "content": "Kept instruction"})
+        self._append({"role": "system", "content": "Dice roll"})
+        self.store.journal_game_context(self.context, [{"op": "log_prune_system", "positions": [1, 4]}])
+        context = GameStore(self.files).read_game_context()
+        self.assertEqual([entry["content"] for entry in context["log"][1:]], ["Mirelle: I open the door", "Kept instruction"])
+
+    # Journals written before positions were recorded remove every system entry but the first
+    def test_prune_system_without_positions(self):
+        self._append({"role": "system", "content": "Dice roll"})
+        self._append({"role": "user", "content": "Mirelle: I open the door"})
+        self.store.journal_game_context(self.context, [{"op": "log_prune_system"}])
+        context = GameStore(self.files).read_game_context()
+        self.assertEqual([entry["role"] for entry in context["log"]], ["system", "user"])
+
+    # Reading must not compact the journal or change any files
+    def test_read_is_read_only(self):
+        self._append({"role": "user", "content": "Mirelle: I open the door"})
+        with open(self.store.journal_path, 'r', encoding="utf-8") as f:
+            journal = f.read()
+        GameStore(self.files).read_game_context()
+        with open(self.store.journal_path, 'r', encoding="utf-8") as f:
+            self.assertEqual(f.read(), journal)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+from logger import logger
+from config import config
+
+# tiktoken is optional. Without it, we fall back to a rough estimate.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Each message costs a few tokens on top of its content, for the role and separators
+MESSAGE_OVERHEAD = 4
+# A rough average for English text
+CHARS_PER_TOKEN = 4
+
+encoding = None
+
+def _get_encoding():
+    global encoding
+    if encoding is None:
+        try:
+            encoding = tiktoken.encoding_for_model(config['openai']['main_model'])
+        except KeyError:
+            logger.warning(f"No tokenizer known for {config['openai']['main_model']}, using o200k_base")
+            encoding = tiktoken.get_encoding("o200k_base")
+    return encoding
+
+def count_tokens(text):
+    if tiktoken is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(_get_encoding().encode(text))
+
+def message_tokens(content):
+    return count_tokens(content) + MESSAGE_OVERHEAD
+
+# Log entries cache their token count, entries from older saves are counted on first use
+def entry_tokens(entry):
+    if "tokens" not in entry:
+        entry["tokens"] = message_tokens(entry["content"])
+    return entry["tokens"]
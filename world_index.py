@@ -0,0 +1,197 @@
+import os
+import re
+import sqlite3
+from tokens import message_tokens
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS world_facts (
+    id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    game_name TEXT NOT NULL,
+    entity TEXT NOT NULL,
+    fact TEXT NOT NULL,
+    kind TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS world_facts_entity ON world_facts (channel_id, game_name, entity);
+CREATE INDEX IF NOT EXISTS world_facts_kind ON world_facts (channel_id, game_name, kind);
+-- The words of each fact, kept in step with world_facts by the triggers
+CREATE VIRTUAL TABLE IF NOT EXISTS world_facts_search USING fts5(
+    entity, fact, content='world_facts', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS world_facts_insert AFTER INSERT ON world_facts BEGIN
+    INSERT INTO world_facts_search (rowid, entity, fact) VALUES (new.id, new.entity, new.fact);
+END;
+CREATE TRIGGER IF NOT EXISTS world_facts_delete AFTER DELETE ON world_facts BEGIN
+    INSERT INTO world_facts_search (world_facts_search, rowid, entity, fact) VALUES ('delete', old.id, old.entity, old.fact);
+END;
+CREATE TRIGGER IF NOT EXISTS world_facts_update AFTER UPDATE OF entity, fact ON world_facts BEGIN
+    INSERT INTO world_facts_search (world_facts_search, rowid, entity, fact) VALUES ('delete', old.id, old.entity, old.fact);
+    INSERT INTO world_facts_search (rowid, entity, fact) VALUES (new.id, new.entity, new.fact);
+END;
+"""
+
+# The most recent sentences kept about each name
+MAX_FACTS_PER_ENTITY = 5
+# Quests are always included, the most recent first
+MAX_QUESTS = 2
+MAX_CANDIDATES = 50
+
+# Capitalised words, joined by spaces or "of the" and the like: "Old Mill", "Tower of Ash"
+NAME = r"[A-Z][\w'’-]*"
+NAME_RE = re.compile(rf"{NAME}(?:(?:\s+(?:of|the|de|du|von|van))*\s+{NAME})*")
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+MARKDOWN_RE = re.compile(r"[*_`#>~|]")
+WORD_RE = re.compile(r"\w{3,}")
+QUEST_RE = re.compile(r"\b(quest|task|mission|bounty|reward|seek|in search of|must (?:find|retrieve|rescue|stop|reach|deliver)|asks? (?:you|the party|them) to)\b", re.IGNORECASE)
+PLACE_BEFORE_RE = re.compile(r"\b(?:in|at|to|from|into|towards?|near|through|across|inside|outside|beyond|reach(?:es|ed)?|enter(?:s|ed)?)\s+(?:the\s+)?$", re.IGNORECASE)
+# "Mirelle says", or "Mirelle, the miller's daughter"
+NPC_AFTER_RE = re.compile(r"^\s*(?:,?\s*(?:says|said|asks|asked|replies|replied|whispers|nods|smiles|laughs|growls|shouts|frowns|grins|sighs|mutters)\b|,\s+(?:the|a|an)\s)")
+TITLES = {"lord", "lady", "captain", "sir", "king", "queen", "master", "mistress", "elder", "brother", "sister"}
+
+# Capitalised at the start of a sentence, not names
+COMMON_WORDS = {
+    "the", "a", "an", "and", "but", "or", "as", "at", "in", "on", "of", "to", "with", "without", "from", "for", "by",
+    "he", "she", "they", "it", "we", "you", "your", "his", "her", "their", "its", "our", "i", "me", "my",
+    "this", "that", "these", "those", "there", "here", "then", "now", "when", "where", "what", "who", "why", "how",
+    "suddenly", "meanwhile", "finally", "however", "still", "yet", "just", "if", "while", "after", "before",
+    "all", "each", "every", "some", "no", "not", "yes", "perhaps", "maybe", "soon", "behind", "ahead",
+    "party", "players", "player", "dm", "storyteller",
+}
+
+# Campaigns share one index
+indexes = {}
+
+def open_world_index(path):
+    if path not in indexes:
+        indexes[path] = WorldIndex(path)
+    return indexes[path]
+
+class WorldIndex:
+    """
+    Facts about the world, for prompts that only carry the recent turns (game.recent_tokens).
+
+    Each sentence of the storyteller's replies that names someone or something is
+    kept under that name, along with a guess at what kind of thing it is. Sentences
+    about quests are kept even without a name. When a player acts, the sentences
+    that share the most words with the action are looked up with SQLite's full text
+    search, so facts from long ago, even from parts of the story that have since
+    been summarized, can be given to the storyteller again.
+
+    Campaigns share the database, so the facts are in a plain table indexed by
+    campaign, and the full text search only holds their words.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Worker processes share the index, see shards.py
+        self.db = sqlite3.connect(path, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        # Indexes from before world_facts kept everything in one full text table,
+        # where only a full scan could find a campaign's facts
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'facts'").fetchone():
+            with self.db:
+                self.db.execute(
+                    "INSERT INTO world_facts (channel_id, game_name, entity, fact, kind) "
+                    "SELECT channel_id, game_name, entity, fact, kind FROM facts ORDER BY rowid"
+                )
+                self.db.execute("DROP TABLE facts")
+
+    # exclude_names are the player characters, who are described in the system prompt
+    def add_text(self, channel_id, game_name, text, exclude_names=()):
+        exclude = {name.lower() for name in exclude_names}
+        facts = [(entity, fact, kind) for entity, fact, kind in extract_facts(text) if entity.lower() not in exclude]
+        if not facts:
+            return
+        with self.db:
+            # A repeated sentence moves to the front, rather than being kept twice
+            self.db.executemany(
+                "DELETE FROM world_facts WHERE channel_id = ? AND game_name = ? AND entity = ? AND fact = ?",
+                [(channel_id, game_name, entity, fact) for entity, fact, _ in facts]
+            )
+            self.db.executemany(
+                "INSERT INTO world_facts (channel_id, game_name, entity, fact, kind) VALUES (?, ?, ?, ?, ?)",
+                [(channel_id, game_name, entity, fact, kind) for entity, fact, kind in facts]
+            )
+            for entity in {entity for entity, _, _ in facts if entity}:
+                self.db.execute(
+                    "DELETE FROM world_facts WHERE id IN (SELECT id FROM world_facts WHERE channel_id = ? AND game_name = ? AND entity = ? "
+                    "ORDER BY id DESC LIMIT -1 OFFSET ?)",
+                    (channel_id, game_name, entity, MAX_FACTS_PER_ENTITY)
+                )
+
+    def has_facts(self, channel_id, game_name):
+        return self.db.execute("SELECT 1 FROM world_facts WHERE channel_id = ? AND game_name = ? LIMIT 1", (channel_id, game_name)).fetchone() is not None
+
+    def rename(self, channel_id, old_name, new_name):
+        with self.db:
+            self.db.execute("DELETE FROM world_facts WHERE channel_id = ? AND game_name = ?", (channel_id, new_name))
+            self.db.execute("UPDATE world_facts SET game_name = ? WHERE channel_id = ? AND game_name = ?", (new_name, channel_id, old_name))
+
+    def clear(self, channel_id, game_name):
+        with self.db:
+            self.db.execute("DELETE FROM world_facts WHERE channel_id = ? AND game_name = ?", (channel_id, game_name))
+
+    # The facts most relevant to query, recent quests first, up to max_tokens.
+    # Facts that appear in skip_text, usually the recent turns, are left out.
+    def relevant_facts(self, channel_id, game_name, query, max_tokens, skip_text=""):
+        rows = list(self.db.execute(
+            "SELECT fact FROM world_facts WHERE channel_id = ? AND game_name = ? AND kind = 'quest' GROUP BY fact ORDER BY MAX(id) DESC LIMIT ?",
+            (channel_id, game_name, MAX_QUESTS)
+        ))
+        terms = {word.lower() for word in WORD_RE.findall(query)} - COMMON_WORDS
+        if terms:
+            rows += self.db.execute(
+                "SELECT world_facts.fact FROM world_facts_search JOIN world_facts ON world_facts.id = world_facts_search.rowid "
+                "WHERE world_facts_search MATCH ? AND world_facts.channel_id = ? AND world_facts.game_name = ? "
+                "ORDER BY bm25(world_facts_search, 4.0, 1.0) LIMIT ?",
+                (" OR ".join(f'"{term}"' for term in sorted(terms)), channel_id, game_name, MAX_CANDIDATES)
+            )
+        facts = []
+        for (fact,) in rows:
+            if fact in facts or fact in skip_text:
+                continue
+            max_tokens -= message_tokens(fact)
+            if max_tokens < 0:
+                break
+            facts.append(fact)
+        return facts
+
+# Yields (entity, sentence, kind) for each name in each sentence. kind is npc, place,
+# quest or thing. Quest sentences without a name have an empty entity.
+def extract_facts(text):
+    sentences = [sentence.strip() for sentence in SENTENCE_RE.split(text) if sentence.strip()]
+    plain = [MARKDOWN_RE.sub("", sentence) for sentence in sentences]
+    # Names seen other than at the start of a sentence, to tell "Mirelle smiles" from "Darkness falls"
+    mid_sentence = {match.group(0) for sentence in plain for match in NAME_RE.finditer(sentence) if match.start() > 0}
+
+    for sentence, plain_sentence in zip(sentences, plain):
+        is_quest = QUEST_RE.search(plain_sentence) is not None
+        found = False
+        for match in NAME_RE.finditer(plain_sentence):
+            entity = _clean_name(match.group(0))
+            if entity is None:
+                continue
+            is_npc = NPC_AFTER_RE.match(plain_sentence[match.end():]) or entity.split()[0].lower() in TITLES
+            if match.start() == 0 and " " not in entity and entity not in mid_sentence and not is_npc:
+                continue
+            found = True
+            if is_quest:
+                kind = "quest"
+            elif PLACE_BEFORE_RE.search(plain_sentence[:match.start()]):
+                kind = "place"
+            elif is_npc:
+                kind = "npc"
+            else:
+                kind = "thing"
+            yield entity, sentence, kind
+        if is_quest and not found:
+            yield "", sentence, "quest"
+
+# Drops leading common words, "The Old Mill" is "Old Mill". None if nothing is left.
+def _clean_name(name):
+    words = name.split()
+    while words and words[0].lower() in COMMON_WORDS:
+        words.pop(0)
+    if not words or len(" ".join(words)) < 3:
+        return None
+    return " ".join(words)